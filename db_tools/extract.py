@@ -0,0 +1,171 @@
+"""
+Streams query results out of PostgreSQL with COPY ... TO STDOUT instead of
+pd.read_sql. The server writes CSV into a pipe on a background thread while
+pandas parses it on the other end, so rows never exist as Python tuples and
+wide tables (e.g. the investigator/beat dummies) come out in a fraction of
+the time and memory. Column dtypes are taken from the query's result
+description rather than guessed.
+
+Used by final_data/build_stages.py and plots/explore.py.
+"""
+
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+CONN_STRING = "dbname = police user = lauren password = llc"
+
+# pg_type oids -> how to parse the column
+INT_TYPES = set([20, 21, 23])          # int8, int2, int4
+FLOAT_TYPES = {700: np.float32, 701: np.float64, 1700: np.float64}  # float4, float8, numeric
+BOOL_TYPES = set([16])
+DATE_TYPES = set([1082, 1114, 1184])   # date, timestamp, timestamptz
+
+
+def column_types(conn, query):
+    '''
+    Returns the (name, type oid) of each column query would return,
+    without running it.
+    '''
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT * FROM ({}) AS q LIMIT 0'.format(query))
+        return [(col[0], col[1]) for col in cur.description]
+    finally:
+        cur.close()
+
+
+def parse_options(columns):
+    '''
+    Turns (name, type oid) pairs into read_csv dtype/parse_dates arguments.
+    Integer columns are left to pandas, so ones with NULLs come back as
+    floats the same way pd.read_sql returns them.
+    '''
+    dtype = {}
+    parse_dates = []
+    for name, oid in columns:
+        if oid in FLOAT_TYPES:
+            dtype[name] = FLOAT_TYPES[oid]
+        elif oid in DATE_TYPES:
+            parse_dates.append(name)
+        elif oid not in INT_TYPES and oid not in BOOL_TYPES:
+            dtype[name] = object
+    return dtype, parse_dates
+
+
+def _copy_to_pipe(conn, query, write_fd, errors):
+    out = os.fdopen(write_fd, 'wb')
+    cur = conn.cursor()
+    try:
+        cur.copy_expert('COPY ({}) TO STDOUT WITH CSV HEADER'.format(query), out)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        cur.close()
+        try:
+            out.close()
+        except (IOError, OSError):
+            # the reader already stopped
+            pass
+
+
+class CopyStream(object):
+    '''
+    A running COPY of query: source is the read end of the pipe the server
+    is writing CSV into, options the read_csv arguments for its columns.
+    '''
+
+    def __init__(self, conn, query):
+        query = query.strip().rstrip(';')
+        dtype, parse_dates = parse_options(column_types(conn, query))
+        self.options = {'dtype': dtype, 'parse_dates': parse_dates,
+                        'true_values': ['t'], 'false_values': ['f'], 'encoding': 'utf-8'}
+        read_fd, write_fd = os.pipe()
+        self.errors = []
+        self.writer = threading.Thread(target=_copy_to_pipe,
+                                       args=(conn, query, write_fd, self.errors))
+        self.writer.daemon = True
+        self.writer.start()
+        self.source = os.fdopen(read_fd, 'rb')
+
+    def close(self):
+        '''
+        Stops reading and waits for the COPY to finish. Raises the server's
+        error, if any, in preference to whatever the parser made of the
+        truncated stream.
+        '''
+        self.source.close()
+        self.writer.join()
+        errors = [e for e in self.errors if not isinstance(e, (IOError, OSError))]
+        if errors:
+            raise errors[0]
+
+
+def read_copy(conn, query, chunksize=None):
+    '''
+    Drop-in for pd.read_sql(query, conn): returns one DataFrame, or an
+    iterator of DataFrames of at most chunksize rows for tables that
+    should not be held in memory at once.
+    '''
+    if chunksize is not None:
+        return copy_chunks(conn, query, chunksize)
+    stream = CopyStream(conn, query)
+    try:
+        frame = pd.read_csv(stream.source, **stream.options)
+    except Exception:
+        stream.close()
+        raise
+    stream.close()
+    return frame
+
+
+def copy_chunks(conn, query, chunksize):
+    '''
+    Generator over the rows of query as DataFrames of at most chunksize
+    rows. Closing it early cancels the rest of the COPY.
+    '''
+    stream = CopyStream(conn, query)
+    try:
+        for frame in pd.read_csv(stream.source, chunksize=chunksize, **stream.options):
+            yield frame
+    except Exception:
+        stream.close()
+        raise
+    finally:
+        if not stream.source.closed:
+            stream.close()
+
+
+def read_table(query, conn_string=CONN_STRING, chunksize=None):
+    '''
+    Opens a connection, reads query (or a bare table name) with read_copy
+    and closes the connection again once everything has been read.
+    '''
+    if len(query.split()) == 1:
+        query = 'SELECT * FROM {}'.format(query)
+    conn = psycopg2.connect(conn_string)
+    if chunksize is not None:
+        return _closing(conn, read_copy(conn, query, chunksize))
+    try:
+        return read_copy(conn, query)
+    finally:
+        conn.close()
+
+
+def _closing(conn, frames):
+    try:
+        for frame in frames:
+            yield frame
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    table = sys.argv[1]
+    df = read_table(table)
+    print('{} rows x {} columns'.format(*df.shape))
+    print(df.dtypes.value_counts())
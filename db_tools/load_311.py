@@ -1,9 +1,18 @@
-from upload_csv import import_csv
+from argparse import ArgumentParser
+
+from upload_csv import import_csvs
+from refresh import refresh_tables
 
 TO_UPLOAD = ["sanitation","vacantbuildings","streetlights_all","vehicles","streetlights_one","treetrims","potholes"]
 
 if __name__=="__main__":
-	for new_table in TO_UPLOAD:
-		fname = "data/311/"+new_table+".csv"
-		import_csv(new_table,fname)
-		print("loaded {}".format(new_table))
\ No newline at end of file
+	parser = ArgumentParser()
+	parser.add_argument('--incremental', action = 'store_true', default = False,
+	                    help = 'only append rows newer than those already loaded and flag the allegations they affect')
+	args = parser.parse_args()
+
+	tables = [(new_table, "data/311/"+new_table+".csv") for new_table in TO_UPLOAD]
+	if args.incremental:
+		refresh_tables(tables, '311')
+	else:
+		import_csvs(tables)
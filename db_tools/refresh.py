@@ -0,0 +1,180 @@
+"""
+Incremental refresh for the 311 and crime tables. A new extract is bulk
+loaded into a staging table, only rows newer than what the table already
+holds are appended, and every allegation whose radius/time window could
+see one of the new rows is written to a stale table. count_311.py's
+recompute_stale then recounts just those allegations' feature cells
+instead of rebuilding the time_distance_* tables.
+"""
+
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+
+from upload_csv import DB_URL, N_WORKERS, quote, import_csv, continue_index
+
+ALLEGATIONS_TABLE = 'allegations'
+STALE_TABLE = 'stale_allegations'
+# same metric projection as count_311.add_projection
+PROJECTED_SRID = 26971
+
+# per kind of extract: the raw date column and its to_timestamp format,
+# the id that is unique per row, and the widest radius (m) and look-back
+# window any feature in count_311.py counts over
+SOURCES = {
+    '311': {'date_col': 'Creation Date', 'date_format': 'MM/DD/YYYY',
+            'id_col': 'Service Request Number', 'radius': 2500, 'window': '3 months'},
+    'crime': {'date_col': 'Date', 'date_format': 'MM/DD/YYYY HH12:MI:SS AM',
+              'id_col': 'ID', 'radius': 2500, 'window': '1 year'},
+    }
+
+
+def table_columns(cur, table):
+    '''
+    Returns (name, type) of every column of table, in order
+    '''
+    cur.execute('''
+        SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum;
+        ''', (quote(table),))
+    return cur.fetchall()
+
+
+def prepare_staging(cur, staging, source):
+    '''
+    Adds the dateobj, geom and geom_proj columns the feature queries use to
+    a freshly loaded staging table
+    '''
+    cur.execute('''ALTER TABLE {} ADD COLUMN dateobj timestamp, ADD COLUMN geom geometry(POINT,4326),
+                   ADD COLUMN geom_proj geometry(POINT,{});'''.format(quote(staging), PROJECTED_SRID))
+    # note that for some reason lat/lng are reverse from what you'd expect
+    cur.execute('UPDATE {} SET dateobj = to_timestamp({}, %s), geom = ST_SetSRID(ST_MakePoint(lng,lat),4326);'.format(
+        quote(staging), quote(source['date_col'])), (source['date_format'],))
+    cur.execute('UPDATE {} SET geom_proj = ST_Transform(geom, {});'.format(quote(staging), PROJECTED_SRID))
+
+
+def select_new_rows(cur, table, staging, source):
+    '''
+    Copies the staging rows that table doesn't have yet into the temp table
+    new_rows, cast to table's column types. Rows are new if they are dated
+    after the latest dateobj in table, or on that date with an id table
+    doesn't have. Returns the columns of new_rows.
+    '''
+    staged = set(name for name, typ in table_columns(cur, staging))
+    columns = [(name, typ) for name, typ in table_columns(cur, table)
+               if name in staged and name != 'index']
+    cur.execute('SELECT max(dateobj) FROM {};'.format(quote(table)))
+    latest = cur.fetchone()[0]
+
+    select = ', '.join('s.{0}::{1} AS {0}'.format(quote(name), typ) for name, typ in columns)
+    if latest is None:
+        where, params = 'TRUE', ()
+    else:
+        id_col = quote(source['id_col'])
+        where = '''s.dateobj > %s OR (s.dateobj = %s AND NOT EXISTS
+                   (SELECT 1 FROM {0} AS t WHERE t.{1} = s.{1}::{2}))'''.format(
+                       quote(table), id_col, dict(columns)[source['id_col']])
+        params = (latest, latest)
+    cur.execute('DROP TABLE IF EXISTS new_rows;')
+    cur.execute('CREATE TEMP TABLE new_rows AS SELECT {} FROM {} AS s WHERE {};'.format(
+        select, quote(staging), where), params)
+    return [name for name, typ in columns]
+
+
+def create_stale_table(cur, allegations = ALLEGATIONS_TABLE, stale_table = STALE_TABLE):
+    '''
+    Creates stale_table, with allegations' crid/officer_id types, if it doesn't exist
+    '''
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS {} AS
+        SELECT crid, officer_id, ''::text AS source_table, now() AS flagged FROM {} WHERE FALSE;
+        '''.format(quote(stale_table), quote(allegations)))
+
+
+def flag_stale(cur, table, source, allegations = ALLEGATIONS_TABLE, stale_table = STALE_TABLE):
+    '''
+    Writes every allegation with one of new_rows inside its radius and
+    look-back window to stale_table, tagged with the source table.
+    Returns the number of allegations flagged.
+    '''
+    create_stale_table(cur, allegations, stale_table)
+    cur.execute('''
+        INSERT INTO {0} (crid, officer_id, source_table, flagged)
+        SELECT a.crid, a.officer_id, %s, now() FROM {1} AS a
+        WHERE EXISTS (SELECT 1 FROM new_rows AS b
+            WHERE ST_DWithin(a.geom_proj, b.geom_proj, %s)
+            AND b.dateobj < a.dateobj
+            AND b.dateobj > (a.dateobj - interval %s))
+        AND NOT EXISTS (SELECT 1 FROM {0} AS s
+            WHERE s.crid = a.crid AND s.officer_id = a.officer_id AND s.source_table = %s);
+        '''.format(quote(stale_table), quote(allegations)),
+        (table, source['radius'], source['window'], table))
+    return cur.rowcount
+
+
+def refresh_table(table, f, kind = '311', allegations = ALLEGATIONS_TABLE, stale_table = STALE_TABLE):
+    '''
+    Appends the rows of csv f that table doesn't have yet and flags the
+    allegations they affect. table must already exist (do the first load
+    with upload_csv.py and add_coords). Returns (rows added, allegations
+    flagged).
+    '''
+    start = time.time()
+    source = SOURCES[kind]
+    staging = table + '_staging'
+
+    conn = psycopg2.connect(DB_URL)
+    try:
+        cur = conn.cursor()
+        cur.execute('DROP TABLE IF EXISTS {};'.format(quote(staging)))
+        conn.commit()
+        import_csv(staging, f, index_columns = ())
+
+        prepare_staging(cur, staging, source)
+        columns = select_new_rows(cur, table, staging, source)
+        col_list = ', '.join(quote(name) for name in columns)
+        continue_index(cur, table)
+        cur.execute('INSERT INTO {0} ({1}) SELECT {1} FROM new_rows ORDER BY dateobj;'.format(
+            quote(table), col_list))
+        added = cur.rowcount
+        flagged = flag_stale(cur, table, source, allegations, stale_table)
+        cur.execute('DROP TABLE {};'.format(quote(staging)))
+        conn.commit()
+    finally:
+        conn.close()
+    print("added {} rows to {}, flagged {} allegations in {:.1f}s".format(
+        added, table, flagged, time.time() - start))
+    return added, flagged
+
+
+def refresh_tables(tables, kind = '311', n_workers = N_WORKERS):
+    '''
+    Refreshes several (table, csv) pairs at once, each on its own connection.
+    Returns a dict of table -> (rows added, allegations flagged)
+    '''
+    # create it up front so the workers don't race to create it
+    conn = psycopg2.connect(DB_URL)
+    try:
+        create_stale_table(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+    refreshed = {}
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        futures = dict((executor.submit(refresh_table, table, f, kind), table) for table, f in tables)
+        for future in as_completed(futures):
+            refreshed[futures[future]] = future.result()
+    return refreshed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Append new rows from an extract and flag affected allegations')
+    parser.add_argument('table')
+    parser.add_argument('csv')
+    parser.add_argument('--kind', choices = sorted(SOURCES), default = '311')
+    args = parser.parse_args()
+    refresh_table(args.table, args.csv, args.kind)
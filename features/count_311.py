@@ -1,6 +1,20 @@
+import io
+import json
+import os
+import sys
+
+import pandas as pd
 import psycopg2 as ps
+from psycopg2 import sql
 from psycopg2.extensions import AsIs
 
+import officer_history
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'geocoding'))
+import polygons
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'db_tools'))
+from extract import read_copy
+
 
 # TABLES_311 = ["311alleylights","311garbage", "311graffiti", "311potholes", "311rodent", "311sanitation", "311streetlightsall", "311streetlightsone", "311trees", "311vap","311vehicles"]
 
@@ -16,6 +30,8 @@ FBI_CODES=['03', '06', '18', '22']
 
 PARTICIPANT_TABLES = ["officers"]
 ALLEGATIONS_TABLE = "allegations"
+# Illinois State Plane East (NAD83), in metres; the radius queries run on this
+PROJECTED_SRID = 26971
 DISTANCES = ['500','1000', '2500']
 TIMES = ['14 days', '3 months','6 months','1 year']
 
@@ -28,6 +44,8 @@ class client:
         self.dbusername="lauren"
         self.dbpasswd="llc"
         self.dbconn=None
+        # build count columns with CREATE TABLE AS + rename rather than ALTER + UPDATE
+        self.materialize=True
     # open a connection to a psql database
     def openConnection(self):
         #
@@ -68,6 +86,25 @@ class client:
 
         self.dbconn.commit()
         cur.close()
+        self.add_projection(tablename)
+
+    def add_projection(self, tablename):
+        # keep a metric copy of geom so radius queries can use ST_DWithin on a plain
+        # geometry (and its GIST index) instead of casting every pair to geography
+        name = "\""+str(tablename)+"\""
+        cur = self.dbconn.cursor()
+        cur.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS geom_proj geometry(POINT,%s);",
+            (AsIs(name), AsIs(PROJECTED_SRID)))
+        cur.execute("UPDATE %s SET geom_proj = ST_Transform(geom, %s) WHERE geom IS NOT NULL;",
+            (AsIs(name), AsIs(PROJECTED_SRID)))
+        cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING GIST(geom_proj);",
+            (AsIs("idx_" + tablename + "_geom_proj"), AsIs(name)))
+        cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s (dateobj);",
+            (AsIs("idx_" + tablename + "_dateobj"), AsIs(name)))
+        cur.execute("ANALYZE %s;", [AsIs(name)])
+        self.dbconn.commit()
+        print("Added geom_proj and indexes to {}".format(tablename))
+        cur.close()
 
 
     def make_new_feature_table_oid(self, allegations, out_table):
@@ -86,113 +123,159 @@ class client:
         print("Created table".format(out_table))
         cur.close()
 
-    def get_crimes_by_radii(self, allegations, crimetable, out_table):
+    def get_crimes_by_radii(self, allegations, crimetable, out_table, stale_table=None):
         print("Starting {}".format(crimetable))
         # out_table = "radius311"
         # out_table = "radiuscrime"
-        
+
         # distances = ['500','1000', '2500', '5000']
         # times = ['7 days', '30 days','3 months','6 months', '1 year']
-        
+
+        buckets = []
         for d in DISTANCES:
             for time in TIMES:
                 for code in FBI_CODES:
-                    cur = self.dbconn.cursor()
-
-                    print("starting {} crimes, {}, {} m".format(code, time, d))
-                    
                     col_name = "crimes_" + code + "_"+ time.replace(" ","") + d + 'm'
-                    cur.execute("alter table %s add column %s int;", (AsIs(out_table), AsIs(col_name)))
-                    print("added col {}".format(col_name))
-                    
-                    cur.execute(
-                        '''
-                        update %s
-                        set %s = agg.num_complaints
-                        from
-                        (SELECT a.crid, COUNT(*) as num_complaints
-                        FROM %s as a JOIN %s as b
-                        ON ST_DWithin(a.geom::geography, b.geom::geography, %s)
-                        AND b.dateobj < a.dateobj
-                        AND b.dateobj > (a.dateobj - interval '%s')
-                        WHERE b."FBI Code" = %s
-                        GROUP BY a.crid) as agg
-                        where %s.crid=agg.crid;
-                        ''', (AsIs(out_table),AsIs(col_name),AsIs(allegations),AsIs(crimetable),AsIs(d),AsIs(time),str(code),AsIs(out_table)))
-                    print("Completed query")
-                    self.dbconn.commit()
-                    cur.close()
+                    buckets.append((col_name, d, time, "pairs.code = '{}'".format(code)))
+
+        codes = ", ".join("'{}'".format(code) for code in FBI_CODES)
+        self.count_in_buckets(allegations, crimetable, out_table, buckets,
+            event_cols=', b."FBI Code" AS code', where='AND b."FBI Code" IN ({})'.format(codes),
+            stale_table=stale_table)
         print("Completed counting {}".format(crimetable))
 
 
 
-    def get_311_radii(self, allegations, table311, out_table):
+    def get_311_radii(self, allegations, table311, out_table, stale_table=None):
         print("Starting {}".format(table311))
         # out_table = "radius311"
         # out_table = "radiuscrime"
-        # cur = self.dbconn.cursor()
         dist2 = ['500','1000', '2500']
         times2 = ['7 days', '3 months']
-        
+
+        buckets = []
         for d in dist2:
             for time in times2:
-                cur = self.dbconn.cursor()
-
-
-                print("starting {}, {} m".format(time, d))
-                
                 col_name = table311 + "_count_" + time.replace(" ","") + d + 'm'
-                cur.execute("alter table %s add column %s int;", (AsIs(out_table), AsIs(col_name)))
-                print("added col {}".format(col_name))
-                
-                cur.execute(
-                    '''
-                    update %s
-                    set %s = agg.num_complaints
-                    from
-                    (SELECT a.crid, COUNT(*) as num_complaints
-                    FROM %s as a JOIN %s as b
-                    ON ST_DWithin(a.geom::geography, b.geom::geography, %s)
-                    AND b.dateobj < a.dateobj
-                    AND b.dateobj > (a.dateobj - interval '%s')
-                    GROUP BY a.crid) as agg
-                    where %s.crid=agg.crid;
-                    ''', (AsIs(out_table),AsIs(col_name),AsIs(allegations),AsIs(table311),AsIs(d),AsIs(time),AsIs(out_table)))
-                print("Completed query")
-                self.dbconn.commit()
-                cur.close()
+                buckets.append((col_name, d, time, None))
 
+        self.count_in_buckets(allegations, table311, out_table, buckets, stale_table=stale_table)
         print("Completed counting {}".format(table311))
 
+    def count_in_buckets(self, allegations, events, out_table, buckets, key=("crid",),
+                         event_cols="", where="", stale_table=None):
+        # Fills every (col_name, distance, time, condition) bucket of out_table in one pass:
+        # each allegation is joined once to the events within the largest distance and the
+        # longest window, and each bucket is a conditional count over those pairs. Buckets
+        # with no events stay NULL, as they did when each one was its own UPDATE.
+        max_d = max(int(d) for col_name, d, time, cond in buckets)
+        max_time = "GREATEST({})".format(", ".join(
+            "interval '{}'".format(time) for time in sorted(set(b[2] for b in buckets))))
+        counts = ",\n".join(
+            "NULLIF(SUM(CASE WHEN pairs.dist <= {} AND pairs.bdate > (pairs.adate - interval '{}'){} THEN 1 ELSE 0 END), 0)::int AS {}".format(
+                d, time, " AND " + cond if cond else "", col_name)
+            for col_name, d, time, cond in buckets)
+        key_cols = ", ".join("pairs." + k for k in key)
+        a_key_cols = ", ".join("a." + k for k in key)
+
+        agg = '''
+            SELECT {0},
+            {1}
+            FROM (SELECT {2}, a.dateobj AS adate, b.dateobj AS bdate,
+                ST_Distance(a.geom_proj, b.geom_proj) AS dist {3}
+                FROM {4} as a JOIN {5} as b
+                ON ST_DWithin(a.geom_proj, b.geom_proj, {6})
+                AND b.dateobj < a.dateobj
+                AND b.dateobj > (a.dateobj - {7})
+                WHERE TRUE {8} {9}) as pairs
+            GROUP BY {0}'''.format(key_cols, counts, a_key_cols, event_cols, allegations, events,
+                max_d, max_time, where, self.stale_filter(stale_table, events))
+
+        print("starting {} buckets of {} in one pass".format(len(buckets), events))
+        # recomputing stale rows only touches a few cells, so that stays an UPDATE
+        if self.materialize and stale_table is None:
+            self.materialize_columns(out_table, [b[0] for b in buckets], key, agg)
+            return
+
+        for col_name, d, time, cond in buckets:
+            self.add_or_reset_column(out_table, col_name, stale_table, events)
+        match = " AND ".join("{0}.{1}=agg.{1}".format(out_table, k) for k in key)
+        sets = ", ".join("{0} = agg.{0}".format(b[0]) for b in buckets)
+        cur = self.dbconn.cursor()
+        cur.execute("update %s set %s from (%s) as agg where %s;",
+            (AsIs(out_table),AsIs(sets),AsIs(agg),AsIs(match)))
+        print("Completed query")
+        self.dbconn.commit()
+        cur.close()
+
+    def materialize_columns(self, out_table, col_names, key, agg):
+        # Builds a new copy of out_table with col_names computed by the agg query in a single
+        # CREATE TABLE AS, swaps it in with a rename in the same transaction (readers see the
+        # old table until the commit), and builds the crid index afterwards. Columns of
+        # out_table with the same names are replaced, all others are carried over.
+        # Views on out_table make the DROP fail; the whole swap is then rolled back, so drop
+        # dependent views first and recreate them afterwards.
+        cur = self.dbconn.cursor()
+        cur.execute("select column_name from information_schema.columns where table_name = %s "
+            "and table_schema = current_schema() order by ordinal_position;", [out_table])
+        keep = [row[0] for row in cur.fetchall() if row[0] not in col_names]
+        new_table = out_table + "_new"
+        select = ", ".join(["o." + c for c in keep] + ["agg." + c for c in col_names])
+        join = " AND ".join("o.{0} = agg.{0}".format(k) for k in key)
+
+        # commits on success, rolls back everything (the new table included) on any error
+        with self.dbconn:
+            cur.execute("drop table if exists %s;", [AsIs(new_table)])
+            cur.execute("create table %s as select %s from %s as o left join (%s) as agg on %s;",
+                (AsIs(new_table), AsIs(select), AsIs(out_table), AsIs(agg), AsIs(join)))
+            print("Built {} with {} new columns".format(new_table, len(col_names)))
+            cur.execute("drop table %s;", [AsIs(out_table)])
+            cur.execute("alter table %s rename to %s;", (AsIs(new_table), AsIs(out_table)))
+        cur.close()
+        self.add_index_crid(out_table)
+        print("Swapped in {}".format(out_table))
+
+    def stale_filter(self, stale_table, source_table):
+        # restricts a radius count to the allegations db_tools/refresh.py flagged for source_table
+        if stale_table is None:
+            return ""
+        return "AND a.crid IN (SELECT crid FROM {} WHERE source_table = '{}')".format(stale_table, source_table)
+
+    def add_or_reset_column(self, out_table, col_name, stale_table, source_table):
+        # on a full run the feature column is new; when recomputing stale rows
+        # it already exists and only their cells are cleared
+        cur = self.dbconn.cursor()
+        if stale_table is None:
+            cur.execute("alter table %s add column %s int;", (AsIs(out_table), AsIs(col_name)))
+            print("added col {}".format(col_name))
+        else:
+            cur.execute("update %s set %s = NULL where crid in (select crid from %s where source_table = %s);",
+                (AsIs(out_table), AsIs(col_name), AsIs(stale_table), source_table))
+            print("reset stale rows of {}".format(col_name))
+        cur.close()
+
+    def recompute_stale(self, allegations, source_table, out_table, stale_table="stale_allegations", crimes=False):
+        # recount only the allegations whose windows saw new source_table rows, then clear their flags
+        if crimes:
+            self.get_crimes_by_radii(allegations, source_table, out_table, stale_table)
+        else:
+            self.get_311_radii(allegations, source_table, out_table, stale_table)
+        cur = self.dbconn.cursor()
+        cur.execute("delete from %s where source_table = %s;", (AsIs(stale_table), source_table))
+        self.dbconn.commit()
+        print("Recomputed {} stale allegations for {}".format(cur.rowcount, source_table))
+        cur.close()
+
     def count_other_complaints(self, allegations, out_table):
         print("Starting {}".format(allegations))
-        
+
+        buckets = []
         for d in DISTANCES:
             for time in TIMES:
-                cur = self.dbconn.cursor()
-
-                print("starting {}, {} m".format(time, d))
-                
                 col_name = "allegationcount" + time.replace(" ","") + d + 'm'
-                cur.execute("alter table %s add column %s int;", (AsIs(out_table), AsIs(col_name)))
-                print("added col {}".format(col_name))
-                
-                cur.execute(
-                    '''
-                    update %s
-                    set %s = agg.num_complaints
-                    from
-                    (SELECT (a.crid, a.officer_id) as allegation_id, COUNT(*) as num_complaints
-                    FROM %s as a JOIN %s as b
-                    ON ST_DWithin(a.geom::geography, b.geom::geography, %s)
-                    AND b.dateobj < a.dateobj
-                    AND b.dateobj > (a.dateobj - interval '%s')
-                    GROUP BY (a.crid,a.officer_id)) as agg
-                    where (%s.crid,%s.officer_id)=agg.allegation_id;
-                    ''', (AsIs(out_table),AsIs(col_name),AsIs(allegations),AsIs(allegations),AsIs(d),AsIs(time),AsIs(out_table),AsIs(out_table)))
-                print("Completed query")
-                self.dbconn.commit()
-                cur.close()
+                buckets.append((col_name, d, time, None))
+
+        self.count_in_buckets(allegations, allegations, out_table, buckets, key=("crid", "officer_id"))
         print("Completed counting {}".format(allegations))
 
 # # '''
@@ -216,31 +299,99 @@ class client:
 #                     GROUP BY a.crid;
 # # '''
 
-    def count_311_calls(self, table311):
-        name = "\""+str(table311)+"\""
-        # main_name = "\""+str(MAIN_TABLE)+"\""
-        print("Starting {}".format(table311))
+    def read_points(self, tablename, key=None):
+        # lng/lat of every located row (plus key), streamed out with COPY
+        cols = ([key] if key else []) + ["ST_X(geom) AS lng", "ST_Y(geom) AS lat"]
+        buf = io.StringIO()
         cur = self.dbconn.cursor()
+        cur.copy_expert("COPY (SELECT {} FROM \"{}\" WHERE geom IS NOT NULL) TO STDOUT WITH CSV HEADER".format(
+            ", ".join(cols), tablename), buf)
+        cur.close()
+        buf.seek(0)
+        return pd.read_csv(buf)
 
+    def read_tracts(self, tracts_table="tracts2010"):
+        # tract polygons, rasterized onto a lookup grid once for all the point tables
+        cur = self.dbconn.cursor()
+        cur.execute("select tractce10, ST_AsGeoJSON(geom) from %s;", [AsIs(tracts_table)])
+        ids, rings = [], []
+        for tract, geometry in cur.fetchall():
+            tract_rings = polygons.geometry_rings(json.loads(geometry))
+            if tract_rings:
+                ids.append(tract)
+                rings.append(tract_rings)
+        cur.close()
+        tracts = polygons.PolygonSet(ids, rings)
+        tracts.build_grid()
+        print("Loaded {} tracts".format(len(ids)))
+        return tracts
+
+    def make_311_by_tract_table(self, tables311, tracts_table="tracts2010", out_table="311bytract"):
+        # count how many 311 calls there were per census tract, for every table in one pass:
+        # the calls are tagged with their tract in process (polygons.PolygonSet) instead of an
+        # ST_Contains join per table, and the counts go in with one COPY instead of an
+        # ALTER + UPDATE per column. Tracts without calls are NULL, as the UPDATE left them.
+        # As in materialize_columns, the new table is out_table (or the tracts, the first
+        # time) left joined to the counts, replacing same-named columns and keeping the rest;
+        # views on out_table have to be dropped first and recreated afterwards.
+        tracts = self.read_tracts(tracts_table)
+        points = {}
+        for table in tables311:
+            df = self.read_points(table)
+            points[table] = (df.lng.values, df.lat.values)
+            print("Read {} {} calls".format(len(df), table))
+        counts = polygons.count_by_polygon(points, tracts)
+        counts.columns = [table + "_count" for table in tables311]
+        counts = counts.replace(0, float("nan"))
+        counts.index.name = "tractce10"
+        count_cols = ", ".join("\"{}\"".format(col) for col in counts.columns)
 
-        # count how many 311 calls there were per census tract and add that to the main table
-
-        col_name = "\""+table311 + "_count\""
-        cur.execute("alter table \"311bytract\" add column %s int;", [AsIs(col_name)])
-        print("success #4")
+        cur = self.dbconn.cursor()
+        cur.execute("create temp table tract_counts as select tractce10 from %s where false;", [AsIs(tracts_table)])
+        cur.execute("alter table tract_counts %s;",
+            [AsIs(", ".join("add column \"{}\" int".format(col) for col in counts.columns))])
+        buf = io.StringIO()
+        counts.to_csv(buf, float_format="%.10g")
+        buf.seek(0)
+        cur.copy_expert("COPY tract_counts (tractce10, {}) FROM STDIN WITH CSV HEADER".format(count_cols), buf)
+
+        cur.execute("select column_name from information_schema.columns where table_name = %s "
+            "and table_schema = current_schema() order by ordinal_position;", [out_table])
+        existing = [row[0] for row in cur.fetchall()]
+        base = "\"" + out_table + "\"" if existing else tracts_table
+        keep = [col for col in existing if col not in counts.columns] or ["tractce10"]
+        select = ", ".join(["o.\"{}\"".format(col) for col in keep] +
+                           ["c.\"{}\"".format(col) for col in counts.columns])
+
+        new_table = "\"" + out_table + "_new\""
+        name = "\"" + out_table + "\""
+        with self.dbconn:
+            cur.execute("drop table if exists %s;", [AsIs(new_table)])
+            cur.execute("create table %s as select %s from %s as o left join tract_counts as c on o.tractce10 = c.tractce10;",
+                (AsIs(new_table), AsIs(select), AsIs(base)))
+            cur.execute("drop table tract_counts;")
+            cur.execute("drop table if exists %s;", [AsIs(name)])
+            cur.execute("alter table %s rename to %s;", (AsIs(new_table), AsIs(name)))
+        cur.close()
+        print("Swapped in {} with counts for {} tables".format(out_table, len(tables311)))
 
-        cur.execute("""
-        update \"311bytract\"
-        set %s = b.cnt
-        from ( 
-            select count(*) as cnt, t.tractce10 as tract from %s as complaints 
-            JOIN \"tracts2010\" as t 
-            on ST_Contains(t.geom, complaints.geom) 
-            group by t.tractce10) as b
-        where tractce10 = b.tract;
-        """, (AsIs(col_name), AsIs(name)))
+    def assign_tracts(self, allegations, tracts_table="tracts2010"):
+        # set tractce10 on allegations from the same in-process tract lookup
+        tracts = self.read_tracts(tracts_table)
+        df = self.read_points(allegations, key="crid").drop_duplicates("crid")
+        df["tractce10"] = tracts.ids_at(df.lng.values, df.lat.values)
+        cur = self.dbconn.cursor()
+        cur.execute("create temp table crid_tracts as select crid, tractce10 from %s where false;", (AsIs(allegations),))
+        buf = io.StringIO()
+        df[["crid", "tractce10"]].to_csv(buf, index=False)
+        buf.seek(0)
+        cur.copy_expert("COPY crid_tracts FROM STDIN WITH CSV HEADER", buf)
+        cur.execute("update %s as a set tractce10 = t.tractce10 from crid_tracts as t where a.crid = t.crid;",
+            [AsIs(allegations)])
+        updated = cur.rowcount
+        cur.execute("drop table crid_tracts;")
         self.dbconn.commit()
-        print("Completed {}".format(name))
+        print("Assigned tracts to {} allegation rows".format(updated))
         cur.close()
 
 
@@ -286,6 +437,36 @@ class client:
         print("Completed  priors")
         cur.close()
 
+    def make_officer_history_table(self, allegations, participant_table, out_table):
+        # priors (plus priors in the last 1/2/5 years, sustained priors and days since the
+        # last complaint) and participant age from one sorted pass in officer_history.py,
+        # written with a single COPY instead of a self-join UPDATE per column
+        alleg_df = read_copy(self.dbconn, sql.SQL("SELECT crid, officer_id, dateobj, finding_edit FROM {}")
+            .format(sql.Identifier(allegations)).as_string(self.dbconn))
+        part_df = read_copy(self.dbconn, sql.SQL("SELECT officer_id, dateobj FROM {}")
+            .format(sql.Identifier(participant_table)).as_string(self.dbconn))
+        age_col = participant_table + "_age"
+        df = officer_history.history(alleg_df)
+        df[age_col] = officer_history.ages(alleg_df, part_df, age_col)[age_col].values
+        print("Computed officer history for {} allegations".format(len(df)))
+
+        cur = self.dbconn.cursor()
+        cur.execute("drop table if exists %s;", [AsIs(out_table)])
+        cur.execute("create table %s as select crid, officer_id from %s where false;", (AsIs(out_table), AsIs(allegations)))
+        int_cols = [col for col in df.columns[2:] if col != "days_since_last"]
+        cur.execute("alter table %s %s, add column days_since_last double precision;", (AsIs(out_table),
+            AsIs(", ".join("add column {} int".format(col) for col in int_cols))))
+        buf = io.StringIO()
+        # %.10g writes whole-number floats (ints with NULLs) without a trailing .0
+        df.to_csv(buf, index=False, float_format="%.10g")
+        buf.seek(0)
+        cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH CSV HEADER").format(sql.Identifier(out_table),
+            sql.SQL(", ").join(sql.Identifier(col) for col in df.columns)).as_string(self.dbconn), buf)
+        self.dbconn.commit()
+        cur.close()
+        self.add_index_crid(out_table)
+        print("Created {}".format(out_table))
+
     def add_index_crid(self, table):
         cur = self.dbconn.cursor()
         ix_name = "idx_" + table + "_crid"
@@ -308,8 +489,12 @@ if __name__ == "__main__":
     except Exception as e:
         print("Error: {}".format(e))
 
-    # for table in TABLES_311:
-    #     dbClient.count_311_calls(table)
+    # 311 calls per census tract, all tables at once
+    # dbClient.make_311_by_tract_table(TABLES_311)
+
+    # the radius queries need geom_proj on allegations and every event table
+    # for table in [ALLEGATIONS_TABLE] + NEW_311 + CRIMES:
+    #     dbClient.add_projection(table)
 
     # for table in NEW_311:
     #     dbClient.get_311_radii("test2",table,"radius311")
@@ -353,7 +538,10 @@ if __name__ == "__main__":
     # dbClient.count_officer_complaints(ALLEGATIONS_TABLE, results)
 
     # print("Starting ages")
-    
+
+    # priors, windowed/sustained priors, days since last complaint and ages in one table
+    # dbClient.make_officer_history_table(ALLEGATIONS_TABLE, "officers", "officer_history")
+
 
     dbClient.closeConnection()
 
@@ -1,6 +1,33 @@
 import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import json
+from argparse import ArgumentParser
 
-def go():
+def sparse_dummies(series, prefix):
+    '''CSR one-hot encoding of a column, named like pd.get_dummies(prefix_sep = " ", dummy_na = True)'''
+
+    codes, uniques = pd.factorize(series, sort = True)
+    columns = ['{} {}'.format(prefix, u) for u in uniques] + ['{} nan'.format(prefix)]
+    codes[codes == -1] = len(uniques)
+    rows = np.arange(len(codes))
+    data = np.ones(len(codes), dtype = np.float32)
+    return sp.csr_matrix((data, (rows, codes)), shape = (len(codes), len(columns))), columns
+
+def write_sparse_dummies(df, fn_base):
+    '''Write investigator and beat dummies as CSR .npz, a json column manifest and the row index'''
+
+    investigators, inv_cols = sparse_dummies(df.investigator_id, "Investigators")
+    beats, beat_cols = sparse_dummies(df.beat, "Beat")
+    ind_dummies = sp.hstack([investigators, beats]).tocsr()
+
+    np.savez(fn_base + ".npz", format = b'csr', shape = ind_dummies.shape, data = ind_dummies.data,
+             indices = ind_dummies.indices, indptr = ind_dummies.indptr)
+    with open(fn_base + ".json", 'w') as f:
+        json.dump({'columns': inv_cols + beat_cols, 'rows': ind_dummies.shape[0]}, f)
+    df.index.to_frame(index = False).to_csv(fn_base + "_index.csv", index = False)
+
+def go(sparse = False):
     df = pd.read_csv("../data/allegations_clean.csv")
 
     df.officer_id.fillna(0, inplace = True)
@@ -22,20 +49,28 @@ def go():
     findings_dum = pd.get_dummies(df.finding_edit, prefix = "Findings", prefix_sep = " ", dummy_na = True)
     outcome_dum = pd.get_dummies(df.outcome_edit, prefix = "Outcomes", prefix_sep = " ", dummy_na = True)
 
-    investigators_dum = pd.get_dummies(df.investigator_id, prefix = "Investigators", prefix_sep = " ", dummy_na = True)
-    beats = pd.get_dummies(df.beat, prefix = "Beat", prefix_sep = " ", dummy_na = True)
-
     dep_dummies = findings_dum.join(outcome_dum)
 
-    ind_dummies = investigators_dum.join(beats)
-    if len(ind_dummies.columns) > 1500:
-        ind_dummies[ind_dummies.columns[:800]].to_csv("indDummyVar1.csv")
-        ind_dummies[ind_dummies.columns[800:]].to_csv("indDummyVar2.csv")
+    if sparse:
+        write_sparse_dummies(df, "indDummyVar")
     else:
-        ind_dummies.to_csv("indDummyVar.csv")
+        investigators_dum = pd.get_dummies(df.investigator_id, prefix = "Investigators", prefix_sep = " ", dummy_na = True)
+        beats = pd.get_dummies(df.beat, prefix = "Beat", prefix_sep = " ", dummy_na = True)
+
+        ind_dummies = investigators_dum.join(beats)
+        if len(ind_dummies.columns) > 1500:
+            ind_dummies[ind_dummies.columns[:800]].to_csv("indDummyVar1.csv")
+            ind_dummies[ind_dummies.columns[800:]].to_csv("indDummyVar2.csv")
+        else:
+            ind_dummies.to_csv("indDummyVar.csv")
 
     dep_dummies.to_csv("depDummyVar.csv")
 
 
 if __name__ == '__main__':
-    go()
+    parser = ArgumentParser()
+    parser.add_argument('--sparse', action = 'store_true', default = False,
+                        help = 'write investigator/beat dummies as CSR .npz instead of csv')
+    args = parser.parse_args()
+
+    go(args.sparse)
@@ -0,0 +1,98 @@
+'''
+Officer complaint-history features from one sorted pass over the
+allegations, instead of count_311.py's self-join of allegations on
+officer_id (quadratic in each officer's complaint count).
+
+Rows are sorted by officer and date once; every count is then the
+difference of two binary searches into that order.
+'''
+
+import numpy as np
+import pandas as pd
+
+PRIOR_YEARS = [1, 2, 5]
+SUSTAINED = 'Sustained'
+
+def to_seconds(dates):
+    return pd.DatetimeIndex(dates).values.astype('datetime64[s]').astype(np.int64)
+
+def sorted_keys(officer_ids, times):
+    '''Return officer-major, time-minor int64 keys and the stride between officers'''
+
+    ranks = pd.factorize(officer_ids, sort = True)[0].astype(np.int64)
+    t0 = times.min()
+    stride = times.max() - t0 + 2
+    return ranks * stride + (times - t0), ranks * stride, t0
+
+def history(allegations):
+    '''
+    Takes a frame with crid, officer_id, dateobj and finding_edit (one row
+    per allegation) and returns crid, officer_id and:
+      priors: the officer's allegations dated on or before this one,
+        counting itself, as count_officer_complaints did
+      priors_{n}yr: the same within the n years up to this one
+      sustained_priors: sustained allegations strictly before this one
+      has_previous: 1 if the officer has an allegation on an earlier date,
+        0 for their first
+      days_since_last: days since that previous allegation, NULL for their
+        first (imputation fills it with 0, so models should read it
+        together with has_previous)
+    '''
+    df = allegations[['crid', 'officer_id', 'dateobj', 'finding_edit']].reset_index(drop = True)
+    dated = df.dateobj.notnull().values & df.officer_id.notnull().values
+    out = df[['crid', 'officer_id']].copy()
+    for col in ['priors'] + ['priors_{}yr'.format(n) for n in PRIOR_YEARS] + ['sustained_priors', 'has_previous', 'days_since_last']:
+        out[col] = np.nan
+    if not dated.any():
+        return out
+
+    d = df[dated]
+    times = to_seconds(d.dateobj)
+    keys, base, t0 = sorted_keys(d.officer_id.values, times)
+    order = np.argsort(keys, kind = 'mergesort')
+    sorted_keys_ = keys[order]
+    first = np.searchsorted(sorted_keys_, base, side = 'left')
+    upto = np.searchsorted(sorted_keys_, keys, side = 'right')
+    before = np.searchsorted(sorted_keys_, keys, side = 'left')
+
+    cols = {'priors': upto - first}
+    for n in PRIOR_YEARS:
+        # same strict lower bound as the radius windows: after date - n years
+        start = to_seconds(d.dateobj - pd.DateOffset(years = n)) - t0
+        lo = np.searchsorted(sorted_keys_, base + np.maximum(start, -1), side = 'right')
+        cols['priors_{}yr'.format(n)] = upto - lo
+
+    # running count of sustained findings in sorted order, read off just before each row's date
+    sustained = (d.finding_edit.values == SUSTAINED)[order].astype(np.int64)
+    running = np.concatenate([[0], np.cumsum(sustained)])
+    cols['sustained_priors'] = running[before] - running[first]
+
+    has_previous = before > first
+    cols['has_previous'] = has_previous.astype(np.int64)
+    previous = np.where(has_previous, (sorted_keys_[np.maximum(before - 1, 0)] - base), 0)
+    cols['days_since_last'] = np.where(has_previous, (times - t0 - previous) / 86400., np.nan)
+
+    for col, values in cols.items():
+        out.loc[dated, col] = values
+    return out
+
+def ages(allegations, participants, col_name = 'officers_age'):
+    '''
+    Whole years between a participant's dateobj and each allegation's, like
+    extract(year from age(a.dateobj, b.dateobj)) in get_participant_age
+    '''
+    merged = allegations[['crid', 'officer_id', 'dateobj']].merge(
+        participants[['officer_id', 'dateobj']].drop_duplicates('officer_id'),
+        on = 'officer_id', how = 'left', suffixes = ('', '_participant'))
+    a = pd.DatetimeIndex(merged.dateobj)
+    b = pd.DatetimeIndex(merged.dateobj_participant)
+    years = a.year - b.year
+    # one less if this year's anniversary hasn't come yet
+    a_rest = (a.month * 100 + a.day) * 86400 + a.hour * 3600 + a.minute * 60 + a.second
+    b_rest = (b.month * 100 + b.day) * 86400 + b.hour * 3600 + b.minute * 60 + b.second
+    years = np.asarray(years - (a_rest < b_rest), dtype = np.float64)
+    # age() counts towards zero when the participant date is the later one
+    years = np.where(np.asarray(a < b), -(b.year - a.year - (b_rest < a_rest)), years)
+    out = merged[['crid', 'officer_id']].copy()
+    out[col_name] = years
+    return out
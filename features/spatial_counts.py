@@ -0,0 +1,207 @@
+'''
+In-process version of the radius/window counts count_311.py computes in
+PostGIS (get_311_radii, get_crimes_by_radii, count_other_complaints), for
+building features from exported lat/lng/date columns without a database.
+
+Points are projected to a local metric plane and events are bucketed in a
+square grid with cells as wide as the largest radius, sorted by cell and
+then time. For every allegation the events in the 3x3 neighbouring cells
+and the longest look-back window are found with binary searches, and every
+distance/window/code bucket is counted from those candidates at once, in
+vectorized batches of allegations.
+'''
+
+import re
+
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+
+# same buckets as count_311.py
+DISTANCES = ['500','1000', '2500']
+TIMES = ['14 days', '3 months','6 months','1 year']
+DISTANCES_311 = ['500','1000', '2500']
+TIMES_311 = ['7 days', '3 months']
+FBI_CODES = ['03', '06', '18', '22']
+
+# WGS84 ellipsoid
+EARTH_A = 6378137.0
+EARTH_E2 = 6.69437999014e-3
+
+BATCH_SIZE = 2000
+
+def project(lat, lng, lat0, lng0):
+    '''Equirectangular projection to metres around (lat0, lng0), using the ellipsoid's radii of curvature there'''
+
+    phi0 = np.radians(lat0)
+    w = 1 - EARTH_E2 * np.sin(phi0) ** 2
+    meridian = EARTH_A * (1 - EARTH_E2) / w ** 1.5
+    normal = EARTH_A / np.sqrt(w)
+    x = np.radians(np.asarray(lng, dtype = np.float64) - lng0) * normal * np.cos(phi0)
+    y = np.radians(np.asarray(lat, dtype = np.float64) - lat0) * meridian
+    return x, y
+
+def window_offset(window):
+    '''Turn a Postgres interval like '14 days' or '3 months' into a pandas offset with the same calendar arithmetic'''
+
+    n, unit = re.match(r'\s*(\d+)\s*([a-z]+?)s?\s*$', window).groups()
+    if unit in ('month', 'year'):
+        return pd.DateOffset(**{unit + 's': int(n)})
+    return pd.Timedelta(**{unit + 's': int(n)})
+
+def to_seconds(dates):
+    return pd.DatetimeIndex(dates).values.astype('datetime64[s]').astype(np.int64)
+
+class EventIndex(object):
+    '''Events in a grid of cell_size metre cells, sorted by cell and then time'''
+
+    def __init__(self, x, y, dates, cell_size, codes = None):
+        self.cell_size = float(cell_size)
+        times = to_seconds(dates)
+        cells = self.cell_ids(x, y)
+
+        self.cells = np.unique(cells)
+        rank = np.searchsorted(self.cells, cells)
+        self.t0 = times.min() if len(times) else 0
+        # rank * stride + t keeps each cell's events together and in time order
+        self.stride = (times.max() - self.t0 + 2) if len(times) else 2
+        keys = rank * self.stride + (times - self.t0)
+        order = np.argsort(keys, kind = 'mergesort')
+
+        self.keys = keys[order]
+        self.x = np.asarray(x, dtype = np.float64)[order]
+        self.y = np.asarray(y, dtype = np.float64)[order]
+        self.times = times[order]
+        self.codes = None if codes is None else np.asarray(codes)[order]
+
+    def cell_ids(self, x, y, dx = 0, dy = 0):
+        cx = np.floor(np.asarray(x) / self.cell_size).astype(np.int64) + dx
+        cy = np.floor(np.asarray(y) / self.cell_size).astype(np.int64) + dy
+        return cx * 2 ** 32 + cy
+
+    def candidates(self, x, y, upper, lower):
+        '''
+        Positions of the events in the cells around each point with lower < time < upper.
+        Returns (point index, event position) pairs.
+        '''
+        starts, counts = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                ids = self.cell_ids(x, y, dx, dy)
+                rank = np.searchsorted(self.cells, ids)
+                found = rank < len(self.cells)
+                found[found] = self.cells[rank[found]] == ids[found]
+                base = rank * self.stride
+                # lower is clipped to -1 and upper to stride - 1 so neither reaches
+                # into the previous or next cell's keys
+                lo = np.searchsorted(self.keys, base + np.maximum(lower - self.t0, -1), side = 'right')
+                hi = np.searchsorted(self.keys, base + np.clip(upper - self.t0, -1, self.stride - 1), side = 'left')
+                starts.append(lo)
+                counts.append(np.where(found, np.maximum(hi - lo, 0), 0))
+        starts = np.concatenate(starts)
+        counts = np.concatenate(counts)
+        points = np.tile(np.arange(len(x)), 9)
+
+        total = counts.sum()
+        offsets = np.cumsum(counts) - counts
+        positions = np.arange(total) - np.repeat(offsets, counts) + np.repeat(starts, counts)
+        return np.repeat(points, counts), positions
+
+    def count(self, x, y, dates, buckets, batch_size = BATCH_SIZE):
+        '''
+        Counts events within distance metres of each point and inside its
+        look-back window (strictly before the point's date, strictly after
+        date - window), optionally only those with the given code.
+        buckets is a list of (col_name, distance, window, code or None).
+        Returns a dict of col_name -> int array.
+        '''
+        x = np.asarray(x, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+        dates = pd.DatetimeIndex(dates)
+        upper = to_seconds(dates)
+        lowers = dict((w, to_seconds(dates - window_offset(w))) for w in set(b[2] for b in buckets))
+        longest = np.min(np.vstack(list(lowers.values())), axis = 0)
+
+        counts = dict((b[0], np.zeros(len(x), dtype = np.int64)) for b in buckets)
+        for start in range(0, len(x), batch_size):
+            batch = slice(start, start + batch_size)
+            points, positions = self.candidates(x[batch], y[batch], upper[batch], longest[batch])
+            d2 = (self.x[positions] - x[batch][points]) ** 2 + (self.y[positions] - y[batch][points]) ** 2
+            times = self.times[positions]
+
+            # each distinct distance, window and code is tested once, then combined per bucket
+            near = dict((d, d2 <= float(d) ** 2) for d in set(b[1] for b in buckets))
+            recent = dict((w, times > lowers[w][batch][points]) for w in lowers)
+            coded = dict((c, self.codes[positions] == c) for c in set(b[3] for b in buckets) if c is not None)
+            n = len(x[batch])
+            for col_name, d, w, c in buckets:
+                mask = near[d] & recent[w]
+                if c is not None:
+                    mask &= coded[c]
+                counts[col_name][batch] = np.bincount(points[mask], minlength = n)
+        return counts
+
+def count_frame(allegations, events, buckets, key, codes = None, batch_size = BATCH_SIZE):
+    '''
+    Runs the counts for an allegations frame (lat, lng, dateobj and the key
+    columns) against an events frame (lat, lng, dateobj) and returns key
+    plus one column per bucket, shaped like the count_311.py tables.
+    '''
+    lat0 = np.nanmean(np.concatenate([allegations.lat.values, events.lat.values]))
+    lng0 = np.nanmean(np.concatenate([allegations.lng.values, events.lng.values]))
+    events = events[events.lat.notnull() & events.lng.notnull() & events.dateobj.notnull()]
+    ex, ey = project(events.lat.values, events.lng.values, lat0, lng0)
+    # allegations without a location or date match nothing, like a NULL geom
+    located = (allegations.lat.notnull() & allegations.lng.notnull() & allegations.dateobj.notnull()).values
+    ax, ay = project(allegations.lat.values[located], allegations.lng.values[located], lat0, lng0)
+
+    index = EventIndex(ex, ey, events.dateobj, max(float(b[1]) for b in buckets),
+                       None if codes is None else events[codes].values)
+    counts = index.count(ax, ay, allegations.dateobj.values[located], buckets, batch_size)
+
+    out = allegations[list(key)].copy()
+    for col_name, d, w, c in buckets:
+        out[col_name] = 0
+        out.loc[located, col_name] = counts[col_name]
+    # count_311.py groups by key over every allegation row, so rows sharing
+    # a key all get the key's total; groups with no events are left NULL
+    cols = [b[0] for b in buckets]
+    out[cols] = out.groupby(list(key))[cols].transform('sum').replace(0, np.nan)
+    return out
+
+def get_311_radii(allegations, events, table311):
+    buckets = [(table311 + "_count_" + time.replace(" ","") + d + 'm', d, time, None)
+               for d in DISTANCES_311 for time in TIMES_311]
+    return count_frame(allegations, events, buckets, ['crid'])
+
+def get_crimes_by_radii(allegations, crimes):
+    buckets = [("crimes_" + code + "_"+ time.replace(" ","") + d + 'm', d, time, code)
+               for d in DISTANCES for time in TIMES for code in FBI_CODES]
+    crimes = crimes.assign(**{"FBI Code": crimes["FBI Code"].astype(str)})
+    crimes = crimes[crimes["FBI Code"].isin(FBI_CODES)]
+    return count_frame(allegations, crimes, buckets, ['crid'], codes = "FBI Code")
+
+def count_other_complaints(allegations):
+    buckets = [("allegationcount" + time.replace(" ","") + d + 'm', d, time, None)
+               for d in DISTANCES for time in TIMES]
+    return count_frame(allegations, allegations, buckets, ['crid', 'officer_id'])
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = 'Radius/window counts from exported lat, lng, dateobj csvs')
+    parser.add_argument('kind', choices = ['311', 'crime', 'complaints'])
+    parser.add_argument('allegations', help = 'csv with crid, officer_id, lat, lng, dateobj')
+    parser.add_argument('output')
+    parser.add_argument('--events', help = 'csv with lat, lng, dateobj (and "FBI Code" for crimes)')
+    parser.add_argument('--name', help = '311 table name used in the column names')
+    args = parser.parse_args()
+
+    allegations = pd.read_csv(args.allegations, parse_dates = ['dateobj'])
+    if args.kind == 'complaints':
+        out = count_other_complaints(allegations)
+    else:
+        events = pd.read_csv(args.events, parse_dates = ['dateobj'], dtype = {"FBI Code": str})
+        if args.kind == 'crime':
+            out = get_crimes_by_radii(allegations, events)
+        else:
+            out = get_311_radii(allegations, events, args.name)
+    out.to_csv(args.output, index = False)
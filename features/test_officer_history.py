@@ -0,0 +1,66 @@
+'''
+Checks officer_history.py against a brute-force pass over every pair of
+an officer's allegations. Run with python -m pytest features.
+'''
+
+import numpy as np
+import pandas as pd
+
+from officer_history import history, PRIOR_YEARS, SUSTAINED
+
+
+def brute_force(allegations):
+    '''Same columns as history, one allegation at a time'''
+    rows = []
+    for _, a in allegations.iterrows():
+        row = {'crid': a.crid, 'officer_id': a.officer_id}
+        if pd.isnull(a.dateobj) or pd.isnull(a.officer_id):
+            rows.append(row)
+            continue
+        same = allegations[(allegations.officer_id == a.officer_id) & allegations.dateobj.notnull()]
+        earlier = same[same.dateobj < a.dateobj]
+        row['priors'] = (same.dateobj <= a.dateobj).sum()
+        for n in PRIOR_YEARS:
+            start = a.dateobj - pd.DateOffset(years = n)
+            row['priors_{}yr'.format(n)] = ((same.dateobj <= a.dateobj) & (same.dateobj > start)).sum()
+        row['sustained_priors'] = (earlier.finding_edit == SUSTAINED).sum()
+        row['has_previous'] = int(len(earlier) > 0)
+        row['days_since_last'] = ((a.dateobj - earlier.dateobj.max()).total_seconds() / 86400.
+                                  if len(earlier) else np.nan)
+        rows.append(row)
+    columns = ['crid', 'officer_id', 'priors'] + ['priors_{}yr'.format(n) for n in PRIOR_YEARS] + \
+              ['sustained_priors', 'has_previous', 'days_since_last']
+    return pd.DataFrame(rows, columns = columns)
+
+
+def random_allegations(n = 400, n_officers = 25, seed = 0):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'crid': np.arange(n),
+        'officer_id': rng.randint(1, n_officers + 1, n).astype(float),
+        # several allegations share a day, and some fall on Feb 29
+        'dateobj': pd.Timestamp('2008-01-01') + pd.to_timedelta(rng.randint(0, 8 * 365, n), unit = 'D'),
+        'finding_edit': rng.choice([SUSTAINED, 'Unfounded', 'Not Sustained', None], n),
+        })
+    df.loc[:4, 'officer_id'] = np.nan
+    df.loc[5:9, 'dateobj'] = pd.NaT
+    df.loc[10, 'dateobj'] = pd.Timestamp('2012-02-29')
+    return df
+
+
+def test_history_matches_brute_force():
+    allegations = random_allegations()
+    got = history(allegations)
+    expected = brute_force(allegations)
+    pd.testing.assert_frame_equal(got, expected, check_dtype = False)
+
+
+def test_first_complaint_has_no_previous():
+    allegations = pd.DataFrame({'crid': [1, 2, 3], 'officer_id': [7., 7., 8.],
+                                'dateobj': pd.to_datetime(['2014-01-01', '2014-03-02', '2014-01-01']),
+                                'finding_edit': [SUSTAINED, None, None]})
+    got = history(allegations)
+    assert got.has_previous.tolist() == [0, 1, 0]
+    assert got.days_since_last.isnull().tolist() == [True, False, True]
+    assert got.days_since_last[1] == 60
+    assert got.sustained_priors.tolist() == [0, 1, 0]
@@ -0,0 +1,85 @@
+'''
+Checks spatial_counts.py against a brute-force count over every
+allegation/event pair. Run with python -m pytest features.
+'''
+
+import numpy as np
+import pandas as pd
+
+from spatial_counts import (EventIndex, count_frame, get_crimes_by_radii, project, window_offset,
+                            DISTANCES, TIMES, FBI_CODES)
+
+
+def brute_force(allegations, events, buckets, codes = None):
+    '''Same counts as count_frame, one pair at a time'''
+    lat0 = np.nanmean(np.concatenate([allegations.lat.values, events.lat.values]))
+    lng0 = np.nanmean(np.concatenate([allegations.lng.values, events.lng.values]))
+    ax, ay = project(allegations.lat.values, allegations.lng.values, lat0, lng0)
+    ex, ey = project(events.lat.values, events.lng.values, lat0, lng0)
+    out = pd.DataFrame({'crid': allegations.crid.values})
+    for col_name, d, w, c in buckets:
+        counts = []
+        for i, date in enumerate(allegations.dateobj):
+            if pd.isnull(date) or np.isnan(ax[i]) or np.isnan(ay[i]):
+                counts.append(0)
+                continue
+            near = (ex - ax[i]) ** 2 + (ey - ay[i]) ** 2 <= float(d) ** 2
+            recent = ((events.dateobj < date) & (events.dateobj > date - window_offset(w))).values
+            mask = near & recent
+            if c is not None:
+                mask &= (events[codes].values == c)
+            counts.append(int(mask.sum()))
+        out[col_name] = counts
+    cols = [b[0] for b in buckets]
+    out[cols] = out.groupby('crid')[cols].transform('sum').replace(0, np.nan)
+    return out
+
+
+def random_frames(n_allegations = 300, n_events = 2000, event_days = 3 * 365, seed = 0):
+    rng = np.random.RandomState(seed)
+    events = pd.DataFrame({
+        'lat': 41.85 + rng.uniform(-0.03, 0.03, n_events),
+        'lng': -87.65 + rng.uniform(-0.04, 0.04, n_events),
+        'dateobj': pd.Timestamp('2012-01-01') + pd.to_timedelta(rng.randint(0, event_days, n_events), unit = 'D'),
+        'FBI Code': rng.choice(FBI_CODES + ['08A'], n_events),
+        })
+    # some allegations come after the last event, as when an extract ends
+    # before the latest allegation
+    dates = pd.Timestamp('2012-01-01') + pd.to_timedelta(rng.randint(0, event_days + 365, n_allegations), unit = 'D')
+    allegations = pd.DataFrame({
+        'crid': rng.randint(0, n_allegations // 2, n_allegations),
+        'lat': 41.85 + rng.uniform(-0.03, 0.03, n_allegations),
+        'lng': -87.65 + rng.uniform(-0.04, 0.04, n_allegations),
+        'dateobj': dates,
+        })
+    allegations.loc[:4, 'lat'] = np.nan
+    allegations.loc[5:9, 'dateobj'] = pd.NaT
+    return allegations, events
+
+
+def test_after_last_event_counts_each_event_once():
+    index = EventIndex(np.array([100., 100.]), np.array([400., 600.]),
+                       pd.to_datetime(['2015-01-01', '2015-02-01']), 500)
+    counts = index.count(np.array([100.]), np.array([500.]), pd.to_datetime(['2015-06-03']),
+                         [('c', '500', '1 year', None)])
+    assert counts['c'].tolist() == [2]
+
+
+def test_count_frame_matches_brute_force():
+    # events spanning less than the longest window, so a search running past
+    # the end of one cell would reach events the window still counts
+    allegations, events = random_frames(event_days = 90)
+    assert (allegations.dateobj > events.dateobj.max()).sum() > 0
+    buckets = [('c' + d + w.replace(' ', ''), d, w, None) for d in DISTANCES for w in TIMES]
+    got = count_frame(allegations, events, buckets, ['crid'], batch_size = 50)
+    expected = brute_force(allegations, events, buckets)
+    pd.testing.assert_frame_equal(got.reset_index(drop = True), expected, check_dtype = False)
+
+
+def test_crimes_match_brute_force():
+    allegations, crimes = random_frames(seed = 1)
+    got = get_crimes_by_radii(allegations, crimes)
+    buckets = [("crimes_" + code + "_" + time.replace(" ", "") + d + 'm', d, time, code)
+               for d in DISTANCES for time in TIMES for code in FBI_CODES]
+    expected = brute_force(allegations, crimes, buckets, codes = 'FBI Code')
+    pd.testing.assert_frame_equal(got.reset_index(drop = True), expected, check_dtype = False)
@@ -0,0 +1,281 @@
+import hashlib
+import itertools
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from psycopg2.pool import ThreadedConnectionPool
+
+from output import read_dummies, write_sparse, write_frame, FORMATS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'db_tools'))
+from extract import CONN_STRING, read_copy
+
+CACHE_DIR = os.path.join('cache', 'tables')
+# investigator/beat CSR block written by features/dummyVariables.py --sparse
+IND_DUMMIES = os.path.join(os.pardir, 'features', 'indDummyVar')
+N_CONNECTIONS = 4
+
+# the slowest reads; submitted first so they never queue behind small ones
+WIDE_TABLES = ['invest1', 'invest2', 'data311', 'datacrime']
+
+#Queries for features; every variant is assembled from these frames
+QUERIES = {
+    'outcome': 'SELECT crid, officer_id, "Findings Sustained" FROM dependent_dum;',
+
+    # superset of the columns any variant needs; stage filters and the
+    # no_affidavit label are derived from finding_edit in pandas
+    'alleg': "SELECT crid, a.officer_id, a.dateobj, a.finding_edit, tractce10, beat, i.investigator_id, \
+                o.race_edit AS officer_race, o.gender AS officer_gender, \
+                (CASE WHEN EXTRACT(dow FROM a.dateobj) NOT IN (0, 6) THEN 1 ELSE 0 END) AS weekend, \
+                (CASE WHEN o.rank IS NOT NULL THEN o.rank ELSE 'UNKNOWN' END) AS rank, \
+                (CASE WHEN investigator_name IN (SELECT concat_ws(', ', officer_last, officer_first) \
+                FROM officers) THEN 1 ELSE 0 END) AS police_investigator \
+                FROM allegations as a LEFT JOIN officers as o \
+                ON (a.officer_id = o.officer_id) \
+                LEFT JOIN investigators AS i ON (a.investigator_id = i.investigator_id) \
+                WHERE tractce10 IS NOT NULL;",
+
+    'invest1': "SELECT * FROM investigator_beat_dum1;",
+
+    'invest2': "SELECT * FROM investigator_beat_dum2;",
+
+    'age': "SELECT crid, officer_id, officers_age, (officers_age^2) AS agesqrd FROM ages;",
+
+    'data311': "SELECT * FROM time_distance_311;",
+
+    'datacrime': "SELECT * FROM time_distance_crime;",
+
+    'priors': "SELECT * FROM prior_complaints;",
+
+    # opt-in (--history): windowed priors from count_311.make_officer_history_table
+    'history': "SELECT crid, officer_id, priors_1yr, priors_2yr, priors_5yr, sustained_priors, \
+                has_previous, days_since_last FROM officer_history;",
+
+    'acs': "SELECT tract_1, pct017, pct1824, pct2534, pct3544, pct4554, pct5564, pct6500, \
+                ptnla, ptnlb, ptnlwh, ptnloth, ptl, ptlths, pthsged, ptsomeco, ptbaplus, ptpov, pctfb \
+                FROM acs;",
+
+    'complainants': "SELECT crid, gender AS complainant_gender, race_edit AS complainant_race, \
+                        age AS complainant_age from complainants;"
+    }
+
+
+def variant_name(stage, dummies, demo):
+    '''Name of a variant, matching the old per-variant scripts (e.g. stage2WithDumWithDemo)'''
+
+    return 'stage{}{}{}'.format(stage, 'WithDum' if dummies else 'NoDum', 'WithDemo' if demo else '')
+
+
+def needed_tables(variants, history = False, sparse = False):
+    '''
+    Names of the queries the given (stage, dummies, demo) variants need.
+    With sparse the investigator/beat dummies come from dummyVariables.py's
+    CSR block rather than the investigator_beat_dum tables
+    '''
+
+    tables = set(['alleg', 'age', 'data311', 'datacrime', 'priors'])
+    if history:
+        tables.add('history')
+    for stage, dummies, demo in variants:
+        if stage == 2:
+            tables.add('outcome')
+        if dummies and not sparse:
+            tables.update(['invest1', 'invest2'])
+        if demo:
+            tables.update(['acs', 'complainants'])
+    return sorted(tables)
+
+
+def table_cache_path(name, cache_dir = CACHE_DIR):
+    '''Local cache file for a query, keyed by the query text'''
+
+    query_hash = hashlib.sha1(QUERIES[name].encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '{}_{}.p'.format(name, query_hash))
+
+
+def read_query(pool, name):
+    '''Run one query on a pooled connection. Returns the frame and the seconds it took'''
+
+    conn = pool.getconn()
+    try:
+        start = time.time()
+        frame = read_copy(conn, QUERIES[name])
+        conn.commit()
+        return frame, time.time() - start
+    finally:
+        pool.putconn(conn)
+
+
+def fetch_tables(names, refresh = False, cache_dir = CACHE_DIR, n_connections = N_CONNECTIONS):
+    '''Run each query once, concurrently over a small connection pool, caching the frames locally'''
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    frames = {}
+    to_query = []
+    for name in names:
+        cache_fn = table_cache_path(name, cache_dir)
+        if os.path.exists(cache_fn) and not refresh:
+            print('Loading {} from {}'.format(name, cache_fn))
+            frames[name] = pd.read_pickle(cache_fn)
+        else:
+            to_query.append(name)
+    if not to_query:
+        return frames
+
+    #The reads are independent, so run them side by side, widest first
+    to_query.sort(key = lambda name: name not in WIDE_TABLES)
+    n_connections = min(n_connections, len(to_query))
+    pool = ThreadedConnectionPool(1, n_connections, CONN_STRING)
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers = n_connections) as executor:
+            futures = dict((executor.submit(read_query, pool, name), name) for name in to_query)
+            for future in as_completed(futures):
+                name = futures[future]
+                frames[name], seconds = future.result()
+                print('Queried {} ({} rows x {} columns) in {:.1f}s'.format(
+                    name, frames[name].shape[0], frames[name].shape[1], seconds))
+                frames[name].to_pickle(table_cache_path(name, cache_dir))
+    finally:
+        #Close connections to database after queries
+        pool.closeall()
+    print('Queried {} tables in {:.1f}s over {} connections'.format(
+        len(to_query), time.time() - start, n_connections))
+
+    return frames
+
+
+def assemble(frames, stage, dummies, demo, history = False, ind_dummies = None):
+    '''
+    Build one variant from the shared frames. Returns the final frame, its
+    dummy columns and, when ind_dummies (read_dummies' matrix, columns and
+    row keys) is given, the investigator/beat (matrix, columns) block
+    aligned with the frame's rows in place of the dense invest columns
+    '''
+
+    alleg_df = frames['alleg']
+    if stage == 1:
+        alleg_df = alleg_df.assign(no_affidavit = (alleg_df.finding_edit == 'No Affidavit').astype(int))
+    else:
+        # matches SQL's finding_edit != 'No Affidavit', which also drops NULLs
+        alleg_df = alleg_df[alleg_df.finding_edit.notnull() & (alleg_df.finding_edit != 'No Affidavit')]
+    alleg_df = alleg_df.drop('finding_edit', axis = 1)
+    if dummies:
+        alleg_df = alleg_df.drop(['beat', 'investigator_id'], axis = 1)
+
+    #Drop duplicate geographic data
+    data311_df = frames['data311'].drop_duplicates('crid')
+    datacrime_df = frames['datacrime'].drop_duplicates('crid')
+
+    #Merge (join) dataframes on shared keys
+    df_final = alleg_df
+    if stage == 2:
+        df_final = frames['outcome'].merge(df_final, on = ['crid', 'officer_id'], how = 'right')
+
+    invest_cols = []
+    if dummies and ind_dummies is not None:
+        keys = ind_dummies[2].assign(dummy_row = np.arange(len(ind_dummies[2])))
+        df_final = df_final.merge(keys, on = ['crid', 'officer_id'], how = 'left')
+    elif dummies:
+        for name in ['invest1', 'invest2']:
+            invest_df = frames[name].drop('index', axis = 1)
+            invest_cols += [col for col in invest_df.columns if col not in ('crid', 'officer_id')]
+            df_final = df_final.merge(invest_df, on = ['crid', 'officer_id'], how = 'left')
+
+    df_final = df_final.merge(frames['age'], on = ['crid', 'officer_id'], how = 'left')\
+                .merge(data311_df, on = 'crid', how = 'left').merge(datacrime_df, on = 'crid', how = 'left')\
+                .merge(frames['priors'], on = ['crid', 'officer_id'], how = 'left')
+    if history:
+        df_final = df_final.merge(frames['history'], on = ['crid', 'officer_id'], how = 'left')
+
+    if demo:
+        acs_df = frames['acs'].drop_duplicates()
+        df_final = df_final.merge(acs_df, how = 'left', left_on = 'tractce10', right_on = 'tract_1')\
+                    .merge(frames['complainants'], how = 'left', on = 'crid')
+
+    to_drop = ['crid', 'tract_1', 'tractce10']
+    dummy_frames = []
+    if dummies:
+        #Dummies for race and rank and drop unneeded columns
+        dummy_frames.append(pd.get_dummies(df_final['rank'], prefix = 'Rank', prefix_sep = ' ', dummy_na = True))
+        dummy_frames.append(pd.get_dummies(df_final[['officer_race', 'officer_gender', 'officer_id']], prefix = 'Officer', prefix_sep = ' ', dummy_na = True))
+        to_drop += ['officer_race', 'rank', 'officer_gender', 'officer_id']
+        if demo:
+            dummy_frames.append(pd.get_dummies(df_final[['complainant_race', 'complainant_gender']], prefix = 'Complainant', prefix_sep = ' ', dummy_na = True))
+            to_drop += ['complainant_gender', 'complainant_race']
+        df_final = pd.concat([df_final] + dummy_frames, axis = 1)
+
+    leading = None
+    if 'dummy_row' in df_final.columns:
+        # rows without a match get the empty row appended at the end, as
+        # the dense left join fills them with NaN and then 0
+        matrix, columns = ind_dummies[0], ind_dummies[1]
+        matrix = sp.vstack([matrix, sp.csr_matrix((1, matrix.shape[1]), dtype = matrix.dtype)]).tocsr()
+        rows = df_final.dummy_row.fillna(matrix.shape[0] - 1).values.astype(np.int64)
+        leading = (matrix[rows], columns)
+        to_drop.append('dummy_row')
+
+    df_final = df_final.drop([col for col in df_final.columns if col in to_drop], axis = 1)
+    dummy_cols = invest_cols + [col for frame in dummy_frames for col in frame.columns]
+    return df_final, dummy_cols, leading
+
+
+def go(output_dir, variants, sparse = False, fmt = 'csv', refresh = False, n_connections = N_CONNECTIONS,
+       history = False, ind_dummies_fn = IND_DUMMIES):
+    '''Fetch every source table once and write each requested variant to output_dir'''
+
+    frames = fetch_tables(needed_tables(variants, history, sparse), refresh, n_connections = n_connections)
+    ind_dummies = None
+    if sparse and any(dummies for stage, dummies, demo in variants):
+        ind_dummies = read_dummies(ind_dummies_fn)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    for stage, dummies, demo in variants:
+        name = variant_name(stage, dummies, demo)
+        print('Building {}'.format(name))
+        df_final, dummy_cols, leading = assemble(frames, stage, dummies, demo, history, ind_dummies)
+        output_fn = os.path.join(output_dir, name + '.csv')
+        if sparse and dummies:
+            write_sparse(df_final, output_fn, dummy_cols, fmt, leading)
+        else:
+            write_frame(df_final, output_fn, fmt)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Export the stage 1/2 feature tables for pipeline.py')
+    parser.add_argument('output_dir')
+    parser.add_argument('--stage', type = int, nargs = '+', choices = [1, 2], default = [1, 2])
+    parser.add_argument('--dummies', choices = ['with', 'without', 'both'], default = 'both',
+                        help = 'investigator/beat, rank and race/gender dummy columns')
+    parser.add_argument('--demo', choices = ['with', 'without', 'both'], default = 'both',
+                        help = 'ACS tract and complainant demographics')
+    parser.add_argument('--sparse', action = 'store_true', default = False,
+                        help = 'store dummy columns as CSR .npz next to the output file')
+    parser.add_argument('--ind_dummies', default = IND_DUMMIES,
+                        help = 'with --sparse, the investigator/beat CSR block from features/dummyVariables.py --sparse')
+    parser.add_argument('--format', choices = FORMATS, default = 'csv',
+                        help = 'csv, or feather/parquet to keep column dtypes')
+    parser.add_argument('--refresh', action = 'store_true', default = False,
+                        help = 'query the database again instead of using cache/tables')
+    parser.add_argument('--n_connections', type = int, default = N_CONNECTIONS,
+                        help = 'database connections used to run the queries concurrently')
+    parser.add_argument('--history', action = 'store_true', default = False,
+                        help = 'add the windowed/sustained priors and days since the last complaint '
+                               'from the officer_history table')
+    args = parser.parse_args()
+
+    options = {'with': [True], 'without': [False], 'both': [False, True]}
+    variants = list(itertools.product(sorted(args.stage), options[args.dummies], options[args.demo]))
+
+    go(args.output_dir, variants, args.sparse, args.format, args.refresh, args.n_connections, args.history,
+       args.ind_dummies)
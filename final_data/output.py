@@ -0,0 +1,97 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+FORMATS = ['csv', 'feather', 'parquet']
+
+
+def output_path(output_fn, fmt):
+    '''Swap output_fn's extension for the one matching fmt'''
+
+    if fmt == 'csv':
+        return output_fn
+    return os.path.splitext(output_fn)[0] + '.' + fmt
+
+
+def write_frame(df, output_fn, fmt = 'csv'):
+    '''Write df as csv, or as typed columnar feather/parquet with the dtypes preserved'''
+
+    output_fn = output_path(output_fn, fmt)
+    if fmt == 'csv':
+        df.to_csv(output_fn)
+        return output_fn
+
+    # columnar formats want a default index and string column names
+    df = df.reset_index(drop = True)
+    df.columns = [str(col) for col in df.columns]
+    if fmt == 'feather':
+        df.to_feather(output_fn)
+    elif fmt == 'parquet':
+        df.to_parquet(output_fn)
+    else:
+        raise ValueError('Unknown format: {}'.format(fmt))
+    return output_fn
+
+
+def dummy_paths(output_fn):
+    '''Return the .npz and column manifest paths that go with a stage csv'''
+
+    base = os.path.splitext(output_fn)[0]
+    return base + '.dummies.npz', base + '.dummies.json'
+
+
+def to_csr(df):
+    '''Build a float32 CSR matrix from a frame of 0/1 dummy columns, one column at a time'''
+
+    rows, cols = [], []
+    for j, col in enumerate(df.columns):
+        nonzero = np.flatnonzero(df[col].fillna(0).values)
+        rows.append(nonzero)
+        cols.append(np.full(len(nonzero), j, dtype = np.int32))
+    rows = np.concatenate(rows) if rows else np.array([], dtype = np.int64)
+    cols = np.concatenate(cols) if cols else np.array([], dtype = np.int32)
+    data = np.ones(len(rows), dtype = np.float32)
+    return sp.coo_matrix((data, (rows, cols)), shape = df.shape).tocsr()
+
+
+def read_dummies(fn_base):
+    '''Read a CSR block from dummyVariables.py --sparse: the matrix, its columns and the crid/officer_id of each row'''
+
+    with np.load(fn_base + '.npz') as npz:
+        matrix = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape = tuple(npz['shape']))
+    with open(fn_base + '.json') as f:
+        columns = json.load(f)['columns']
+    keys = pd.read_csv(fn_base + '_index.csv')
+    return matrix, columns, keys
+
+
+def write_sparse(df, output_fn, dummy_cols, fmt = 'csv', leading = None):
+    '''
+    Write the dummy columns as CSR (.npz plus a json column manifest) and
+    everything else to output_fn. leading is an optional (matrix, columns)
+    block, already aligned with df's rows, placed before df's dummy columns
+    '''
+
+    # by position: the rank/race dummies can repeat a name (e.g. 'Officer nan')
+    dummy_cols = set(dummy_cols)
+    positions = [i for i, col in enumerate(df.columns) if col in dummy_cols]
+    dummies = to_csr(df.iloc[:, positions])
+    dummy_cols = list(df.columns[positions])
+    if leading is not None:
+        dummies = sp.hstack([leading[0], dummies]).tocsr()
+        dummy_cols = list(leading[1]) + dummy_cols
+    npz_fn, manifest_fn = dummy_paths(output_fn)
+
+    # same keys as scipy.sparse.save_npz, so either loader can read it
+    np.savez(npz_fn, format = b'csr', shape = dummies.shape, data = dummies.data,
+             indices = dummies.indices, indptr = dummies.indptr)
+    with open(manifest_fn, 'w') as f:
+        json.dump({'columns': dummy_cols, 'rows': len(df)}, f)
+
+    others = sorted(set(range(df.shape[1])) - set(positions))
+    write_frame(df.iloc[:, others], output_fn, fmt)
+    print('Wrote {} dummy columns ({} nonzero) to {}'.format(len(dummy_cols), dummies.nnz, npz_fn))
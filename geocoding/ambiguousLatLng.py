@@ -1,29 +1,31 @@
-import pandas as pd
-import ast
+from argparse import ArgumentParser
 
-def go():
-    def latfunc(x):
-        dic = ast.literal_eval(x)[0]
-        lat = dic['geometry']['location']['lat']
-        return lat
+from locations import read_locations
+from polygons import load_polygons, read_beats, resolve_ambiguous
 
-    def lngfunc(x):
-        dic = ast.literal_eval(x)[0]
-        lng = dic['geometry']['location']['lng']
-        return lng
+def go(allegations_fn = None, boundary_fn = None, beats_fn = None, tracts_fn = None):
+    df = read_locations("ambiguous_incident_addresses.csv")
 
-    df = pd.read_csv("ambiguous_incident_addresses.csv", index_col = 0)
+    if not (boundary_fn or beats_fn or tracts_fn):
+        # no polygons to check candidates against: take the first one
+        ambiguous = df[df.lat.isnull()][["address"]]
+        ambiguous.to_csv("ambiguousUnresolved.csv")
 
-    ambiguous = df[df.geocode.isnull()].drop("geocode", axis = 1)
-    ambiguous.to_csv("ambiguousUnresolved.csv")
+        partial = df[df.lat.notnull()]
+        partial[["lat", "lng"]].to_csv("ambiguousResolved.csv")
+        return
 
-    partial = df[df.geocode.notnull()]
-
-    df_final = pd.DataFrame(index = partial.index)
-    df_final["lat"] = partial.geocode.apply(latfunc)
-    df_final["lng"] = partial.geocode.apply(lngfunc)
-
-    df_final.to_csv("ambiguousResolved.csv")
+    if allegations_fn:
+        df = df.join(read_beats(allegations_fn), how = "left")
+    resolved, unresolved = resolve_ambiguous(df, *load_polygons(boundary_fn, beats_fn, tracts_fn))
+    resolved.to_csv("ambiguousResolved.csv", index = False)
+    unresolved.to_csv("ambiguousUnresolved.csv", index = False)
 
 if __name__ == '__main__':
-    go()
+    parser = ArgumentParser(description = 'Pick a location for the addresses with several geocoder results')
+    parser.add_argument('--allegations', help = 'csv with crid and beat')
+    parser.add_argument('--boundary', help = 'GeoJSON of the city limits')
+    parser.add_argument('--beats', help = 'GeoJSON of the police beats (beat_num)')
+    parser.add_argument('--tracts', help = 'GeoJSON of the 2010 census tracts (tractce10)')
+    args = parser.parse_args()
+    go(args.allegations, args.boundary, args.beats, args.tracts)
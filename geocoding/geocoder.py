@@ -0,0 +1,263 @@
+"""
+Geocodes incident addresses concurrently. Every key gets its own request
+rate and number of requests in flight, and keys that run out of quota are
+dropped while the others carry on.
+
+Results are appended to a JSON-lines cache keyed by normalized address as
+they come in, so repeated addresses are only requested once and an
+interrupted run picks up where it stopped (no more manual start offsets).
+The provider is pluggable; GoogleProvider takes a base_url so a local stub
+server can stand in for the real API.
+"""
+
+import asyncio
+import csv
+import json
+import os
+import re
+import time
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from locations import LOCATION_COLUMNS, first_location
+
+GOOGLE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+CACHE_FN = 'geocode_cache.jsonl'
+KEY_FN = 'google_api_keys.txt'
+RATE = 10.0
+CONCURRENCY = 4
+
+# a key answering with one of these is done for the day
+QUOTA_STATUSES = set(['OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT', 'REQUEST_DENIED'])
+# answers worth keeping; anything else is retried on the next run
+FINAL_STATUSES = set(['OK', 'ZERO_RESULTS'])
+
+
+def normalize(address):
+    '''
+    Cache key for an address: upper case, single spaces, no stray
+    punctuation, and the '100.0 S ...' float artifact from add1 dropped
+    '''
+    address = re.sub(r'(\d+)\.0\b', r'\1', address.upper())
+    address = re.sub(r'[^\w\s,#-]', ' ', address)
+    address = re.sub(r'\s*,\s*', ', ', address)
+    return re.sub(r'\s+', ' ', address).strip(' ,')
+
+
+class AddressCache:
+    '''Geocoder answers by normalized address, persisted as JSON lines'''
+
+    def __init__(self, fn = CACHE_FN):
+        self.fn = fn
+        self.entries = {}
+        if os.path.exists(fn):
+            with open(fn) as f:
+                for line in f:
+                    # a run killed mid-write can leave a partial last line
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['address']] = entry
+        self.out = open(fn, 'a')
+
+    def __contains__(self, address):
+        return normalize(address) in self.entries
+
+    def get(self, address):
+        return self.entries.get(normalize(address))
+
+    def put(self, address, status, results):
+        entry = {'address': normalize(address), 'status': status, 'results': results}
+        self.entries[entry['address']] = entry
+        self.out.write(json.dumps(entry) + '\n')
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+
+class RateLimiter:
+    '''Spaces out calls to at most rate per second'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class GoogleProvider:
+    '''Google Geocoding API (or anything answering like it at base_url)'''
+
+    def __init__(self, base_url = GOOGLE_URL, timeout = 10):
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def fetch(self, address, key):
+        query = urllib.parse.urlencode({'address': address, 'key': key})
+        with urllib.request.urlopen('{}?{}'.format(self.base_url, query), timeout = self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    async def geocode(self, address, key, executor = None):
+        '''Returns the API's answer as a dict with status and results'''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, self.fetch, address, key)
+
+
+PROVIDERS = {'google': GoogleProvider}
+
+
+async def geocode_addresses(addresses, keys, provider, cache, rate = RATE, concurrency = CONCURRENCY,
+                            refresh = False):
+    '''
+    Geocodes every address not in the cache yet (every address, with
+    refresh, replacing what is cached), with concurrency requests in flight
+    and at most rate requests a second per key.
+    Returns the number of addresses that got no answer.
+    '''
+    todo = {}
+    for address in addresses:
+        if refresh or address not in cache:
+            todo.setdefault(normalize(address), address)
+    print('{} addresses, {} {}'.format(len(set(normalize(a) for a in addresses)), len(todo),
+                                       'to refresh' if refresh else 'not cached yet'))
+    queue = asyncio.Queue()
+    for address in todo.values():
+        queue.put_nowait(address)
+
+    executor = ThreadPoolExecutor(max_workers = max(1, len(keys) * concurrency))
+    exhausted = set()
+    answered = set()
+    in_flight = [0]
+
+    async def worker(key, limiter):
+        while key not in exhausted:
+            if queue.empty():
+                # a request still in flight may come back to the queue when its key runs out
+                if not in_flight[0]:
+                    return
+                await asyncio.sleep(0.05)
+                continue
+            address = queue.get_nowait()
+            in_flight[0] += 1
+            try:
+                await limiter.wait()
+                answer = await provider.geocode(address, key, executor)
+            except Exception as err:
+                print('Error: {} ({})'.format(err, address))
+                continue
+            finally:
+                in_flight[0] -= 1
+            status = answer.get('status')
+            if status in QUOTA_STATUSES:
+                if key not in exhausted:
+                    print('key ...{} done: {}'.format(key[-4:], status))
+                exhausted.add(key)
+                queue.put_nowait(address)
+            elif status in FINAL_STATUSES:
+                cache.put(address, status, answer.get('results', []))
+                answered.add(normalize(address))
+            else:
+                print('Error: {} ({})'.format(status, address))
+
+    workers = []
+    for key in keys:
+        limiter = RateLimiter(rate)
+        workers += [worker(key, limiter) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        executor.shutdown(wait = False)
+
+    missing = len(todo) - len(answered)
+    if missing:
+        print('{} addresses left; rerun (with fresh keys) to continue'.format(missing))
+    return missing
+
+
+def read_addresses(fn):
+    '''
+    Returns (crid, address) pairs from allegations_addresses.csv (add1, add2,
+    city) or from a file that already has an address column
+    '''
+    with open(fn) as csvfile:
+        reader = csv.DictReader(csvfile)
+        origin_addresses = []
+        for row in reader:
+            if 'address' in row:
+                address = row['address']
+            else:
+                address = '{} {}, {}'.format(row['add1'], row['add2'], row['city'])
+            origin_addresses.append((row['crid'], address))
+    return origin_addresses
+
+
+def write_results(origin_addresses, cache, ambig_fn, unambig_fn):
+    '''
+    Writes crid, address, lat, lng, location_type, n_results, geocode rows
+    for ambiguousLatLng.py and unambiguousLatLng.py: one match goes to
+    unambig_fn, several matches or none yet to ambig_fn. lat/lng are the
+    first result's and the full answer is kept as JSON in geocode (empty
+    when there is no answer)
+    '''
+    fieldnames = ['crid', 'address'] + LOCATION_COLUMNS + ['geocode']
+    with open(ambig_fn, 'w') as ambig_file, open(unambig_fn, 'w') as unambig_file:
+        ambig_writer = csv.DictWriter(ambig_file, fieldnames = fieldnames)
+        unambig_writer = csv.DictWriter(unambig_file, fieldnames = fieldnames)
+        ambig_writer.writeheader()
+        unambig_writer.writeheader()
+        for crid, address in origin_addresses:
+            entry = cache.get(address)
+            results = entry['results'] if entry else []
+            row = dict(zip(LOCATION_COLUMNS, first_location(results)))
+            row.update({'crid': crid, 'address': address, 'geocode': json.dumps(results) if results else ''})
+            if len(results) == 1:
+                unambig_writer.writerow(row)
+            else:
+                ambig_writer.writerow(row)
+
+
+def go(addresses_fn, ambig_fn, unambig_fn, key_fn = KEY_FN, cache_fn = CACHE_FN, provider = 'google',
+       base_url = GOOGLE_URL, rate = RATE, concurrency = CONCURRENCY, refresh = False):
+    origin_addresses = read_addresses(addresses_fn)
+    with open(key_fn) as key_file:
+        keys = [key.strip() for key in key_file if key.strip()]
+
+    cache = AddressCache(cache_fn)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(geocode_addresses([address for crid, address in origin_addresses], keys,
+                                                  PROVIDERS[provider](base_url), cache, rate, concurrency,
+                                                  refresh))
+    finally:
+        loop.close()
+        write_results(origin_addresses, cache, ambig_fn, unambig_fn)
+        cache.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Geocode incident addresses with a persistent cache')
+    parser.add_argument('--addresses', default = 'allegations_addresses.csv')
+    parser.add_argument('--ambiguous', default = 'ambiguous_incident_addresses.csv')
+    parser.add_argument('--unambiguous', default = 'unambiguous_incident_addresses.csv')
+    parser.add_argument('--keys', default = KEY_FN)
+    parser.add_argument('--cache', default = CACHE_FN)
+    parser.add_argument('--provider', choices = sorted(PROVIDERS), default = 'google')
+    parser.add_argument('--base_url', default = GOOGLE_URL, help = 'e.g. a local stub server for testing')
+    parser.add_argument('--rate', type = float, default = RATE, help = 'requests per second per key')
+    parser.add_argument('--concurrency', type = int, default = CONCURRENCY, help = 'requests in flight per key')
+    parser.add_argument('--refresh', action = 'store_true', default = False,
+                        help = 'request every address again, replacing the cached answers')
+    args = parser.parse_args()
+
+    go(args.addresses, args.ambiguous, args.unambiguous, args.keys, args.cache, args.provider,
+       args.base_url, args.rate, args.concurrency, args.refresh)
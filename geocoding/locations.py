@@ -0,0 +1,88 @@
+"""
+Pulls lat/lng out of stored geocoder answers. geocoder.write_results now
+writes typed lat, lng, location_type and n_results columns next to the
+answer (stored as JSON), so those files need no parsing at all; older files
+with a Python-repr geocode column, and the JSON-lines cache itself, are
+parsed once per record and the fields read off in the same pass.
+"""
+
+import ast
+import json
+
+import numpy as np
+import pandas as pd
+
+LOCATION_COLUMNS = ['lat', 'lng', 'location_type', 'n_results']
+
+
+def parse_geocode(text):
+    '''Results list from a stored geocode: JSON, or the str() repr older runs wrote'''
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def first_location(results):
+    '''(lat, lng, location_type, n_results) of the first result, NaNs when there is none'''
+    if not results:
+        return np.nan, np.nan, None, 0
+    geometry = results[0]['geometry']
+    return (geometry['location']['lat'], geometry['location']['lng'],
+            geometry.get('location_type'), len(results))
+
+
+def extract_locations(geocodes):
+    '''Series of stored geocodes (NaN for none) -> frame of LOCATION_COLUMNS on the same index'''
+    rows = [first_location(parse_geocode(g) if isinstance(g, str) and g else None) for g in geocodes]
+    out = pd.DataFrame.from_records(rows, columns = LOCATION_COLUMNS, index = geocodes.index)
+    out['n_results'] = out.n_results.astype(np.int64)
+    return out
+
+
+def candidate_locations(geocodes):
+    '''
+    Every result of every stored geocode, one row each: the geocodes' index
+    (as 'row'), the result's rank in the answer, lat, lng and location_type
+    '''
+    rows = []
+    for row, g in zip(geocodes.index, geocodes):
+        if not (isinstance(g, str) and g):
+            continue
+        for rank, result in enumerate(parse_geocode(g)):
+            geometry = result['geometry']
+            rows.append((row, rank, geometry['location']['lat'], geometry['location']['lng'],
+                         geometry.get('location_type')))
+    return pd.DataFrame.from_records(rows, columns = ['row', 'rank', 'lat', 'lng', 'location_type'])
+
+
+def read_locations(fn):
+    '''
+    Reads a crid, address, geocode csv from geocoder.write_results (or the
+    older incidents_geocoded.py) and returns it indexed by crid with the
+    LOCATION_COLUMNS filled in
+    '''
+    df = pd.read_csv(fn, index_col = 0)
+    if 'lat' in df.columns:
+        return df
+    # crids repeat, so the columns are assigned by position rather than joined
+    locations = extract_locations(df.geocode)
+    for col in LOCATION_COLUMNS:
+        df[col] = locations[col].values
+    return df
+
+
+def cache_locations(cache_fn):
+    '''LOCATION_COLUMNS by normalized address straight from a geocoder JSON-lines cache'''
+    addresses, rows = [], []
+    with open(cache_fn) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            addresses.append(entry['address'])
+            rows.append(first_location(entry['results']))
+    out = pd.DataFrame.from_records(rows, columns = LOCATION_COLUMNS, index = pd.Index(addresses, name = 'address'))
+    # later lines for the same address supersede earlier ones, as in AddressCache
+    return out[~out.index.duplicated(keep = 'last')]
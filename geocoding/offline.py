@@ -0,0 +1,180 @@
+"""
+Offline geocoding against addresses we have already resolved. The
+reference index is allGeocoded.csv (crid, lat, lng) joined to the
+addresses in allegations_addresses.csv, keyed by the same normalized
+'add1 add2, city' the remote geocoder caches under.
+
+A batch of addresses is resolved with merges: first on the exact
+normalized address, then on the block (street plus house number rounded
+down to the hundred) with the median point of our known addresses on it,
+then the same block on the closest known spelling of the street. Only
+what is left goes to the remote geocoder.
+"""
+
+import asyncio
+import difflib
+from argparse import ArgumentParser
+
+import pandas as pd
+
+import geocoder
+from geocoder import normalize, read_addresses
+
+GEOCODED_FN = 'allGeocoded.csv'
+ADDRESSES_FN = 'allegations_addresses.csv'
+STREET_CUTOFF = 0.85
+
+SUFFIXES = {'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'BOULEVARD': 'BLVD', 'DRIVE': 'DR',
+            'ROAD': 'RD', 'PLACE': 'PL', 'PARKWAY': 'PKWY', 'COURT': 'CT', 'TERRACE': 'TER',
+            'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W'}
+ADDRESS_RE = r'^\s*(\d+)(?:\.\d+)?\s+(.*?)\s*,\s*(.*?)\s*$'
+
+
+def parse_addresses(addresses):
+    '''
+    Splits 'add1 add2, city' strings into a frame of the normalized key,
+    block (house number rounded down to the hundred), street and city
+    (state and zip dropped), vectorized over the whole batch
+    '''
+    addresses = pd.Series(addresses).astype(str)
+    parts = addresses.str.upper().str.extract(ADDRESS_RE, expand = True)
+    parts.columns = ['number', 'street', 'city']
+    street = parts.street.str.replace(r'[^\w\s]', ' ', regex = True).str.split()
+    street = street.apply(lambda words: ' '.join(SUFFIXES.get(w, w) for w in words)
+                          if isinstance(words, list) else None)
+    return pd.DataFrame({
+        'key': addresses.apply(normalize).values,
+        'block': (pd.to_numeric(parts.number, errors = 'coerce') // 100 * 100).values,
+        'street': street.values,
+        'city': parts.city.str.replace(r'\s+(IL|ILLINOIS)?\s*\d{5}(-\d{4})?$', '', regex = True)
+                     .str.replace(r'\s+(IL|ILLINOIS)$', '', regex = True).values,
+        })
+
+
+class AddressIndex:
+    '''Known points by normalized address and by block'''
+
+    def __init__(self, reference):
+        # reference: address, lat, lng
+        ref = pd.concat([parse_addresses(reference.address.values),
+                         reference[['lat', 'lng']].reset_index(drop = True)], axis = 1)
+        ref = ref.dropna(subset = ['lat', 'lng'])
+        self.exact = ref.groupby('key')[['lat', 'lng']].median()
+        blocks = ref.dropna(subset = ['block', 'street'])
+        self.blocks = blocks.groupby(['city', 'street', 'block'])[['lat', 'lng']].median()
+        self.streets = dict((city, sorted(set(group.street)))
+                            for city, group in blocks.groupby('city'))
+
+    @classmethod
+    def from_files(cls, geocoded_fn = GEOCODED_FN, addresses_fn = ADDRESSES_FN):
+        # allGeocoded.csv was concatenated from several runs and repeats its header
+        geocoded = pd.read_csv(geocoded_fn).apply(pd.to_numeric, errors = 'coerce').dropna().drop_duplicates('crid')
+        addresses = pd.DataFrame(read_addresses(addresses_fn), columns = ['crid', 'address'])
+        addresses['crid'] = pd.to_numeric(addresses.crid, errors = 'coerce')
+        reference = addresses.drop_duplicates('crid').merge(geocoded, on = 'crid')
+        print('Indexed {} geocoded addresses'.format(len(reference)))
+        return cls(reference)
+
+    def closest_street(self, city, street):
+        matches = difflib.get_close_matches(street, self.streets.get(city, []), n = 1, cutoff = STREET_CUTOFF)
+        return matches[0] if matches else None
+
+    def resolve(self, addresses):
+        '''
+        Returns a frame with lat, lng and match ('exact', 'block', 'fuzzy'
+        or None for a miss) for each address, in order
+        '''
+        parsed = parse_addresses(addresses)
+        out = parsed[['key']].join(self.exact, on = 'key')
+        out['match'] = None
+        out.loc[out.lat.notnull(), 'match'] = 'exact'
+
+        missing = out.lat.isnull()
+        block = parsed[missing].join(self.blocks, on = ['city', 'street', 'block'])
+        found = block.lat.notnull()
+        out.loc[block.index[found], ['lat', 'lng']] = block.loc[found, ['lat', 'lng']].values
+        out.loc[block.index[found], 'match'] = 'block'
+
+        # misspelt streets: look up each distinct unknown street once
+        missing = out.lat.isnull() & parsed.street.notnull() & parsed.block.notnull()
+        fuzzy = parsed[missing].copy()
+        pairs = fuzzy[['city', 'street']].drop_duplicates()
+        closest = dict(((c, s), self.closest_street(c, s)) for c, s in pairs.itertuples(index = False))
+        fuzzy['street'] = [closest[(c, s)] for c, s in zip(fuzzy.city, fuzzy.street)]
+        fuzzy = fuzzy.dropna(subset = ['street']).join(self.blocks, on = ['city', 'street', 'block'])
+        found = fuzzy.lat.notnull()
+        out.loc[fuzzy.index[found], ['lat', 'lng']] = fuzzy.loc[found, ['lat', 'lng']].values
+        out.loc[fuzzy.index[found], 'match'] = 'fuzzy'
+        return out[['lat', 'lng', 'match']]
+
+
+def resolve_remote(addresses, key_fn, cache_fn, base_url, rate, concurrency):
+    '''
+    Geocodes addresses remotely (through the geocoder cache). Returns lat/lng
+    for the unambiguous answers and None for the rest
+    '''
+    with open(key_fn) as key_file:
+        keys = [key.strip() for key in key_file if key.strip()]
+    cache = geocoder.AddressCache(cache_fn)
+    # GoogleProvider finds the loop with get_event_loop(), which before 3.5.3
+    # returns the set loop rather than the running one
+    try:
+        previous = asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        previous = None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(geocoder.geocode_addresses(
+            addresses, keys, geocoder.GoogleProvider(base_url), cache, rate, concurrency))
+    finally:
+        asyncio.set_event_loop(previous)
+        loop.close()
+        cache.close()
+
+    points = []
+    for address in addresses:
+        entry = cache.get(address)
+        if entry and len(entry['results']) == 1:
+            location = entry['results'][0]['geometry']['location']
+            points.append((location['lat'], location['lng']))
+        else:
+            points.append(None)
+    return points
+
+
+def go(addresses_fn, output_fn, remote = False, geocoded_fn = GEOCODED_FN, reference_fn = ADDRESSES_FN,
+       key_fn = geocoder.KEY_FN, cache_fn = geocoder.CACHE_FN, base_url = geocoder.GOOGLE_URL,
+       rate = geocoder.RATE, concurrency = geocoder.CONCURRENCY):
+    index = AddressIndex.from_files(geocoded_fn, reference_fn)
+    batch = pd.DataFrame(read_addresses(addresses_fn), columns = ['crid', 'address'])
+    resolved = pd.concat([batch, index.resolve(batch.address.values)], axis = 1)
+
+    misses = resolved.match.isnull()
+    if remote and misses.any():
+        points = resolve_remote(list(resolved.address[misses]), key_fn, cache_fn,
+                                base_url, rate, concurrency)
+        for i, point in zip(resolved.index[misses], points):
+            if point is not None:
+                resolved.loc[i, ['lat', 'lng']] = point
+                resolved.loc[i, 'match'] = 'remote'
+
+    print(resolved.match.fillna('unresolved').value_counts().to_string())
+    resolved.to_csv(output_fn, index = False)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Geocode addresses from our own geocoded history first')
+    parser.add_argument('addresses', help = 'csv with crid and add1/add2/city or address')
+    parser.add_argument('output')
+    parser.add_argument('--remote', action = 'store_true', default = False,
+                        help = 'send addresses the index misses to the remote geocoder')
+    parser.add_argument('--geocoded', default = GEOCODED_FN)
+    parser.add_argument('--reference', default = ADDRESSES_FN)
+    parser.add_argument('--keys', default = geocoder.KEY_FN)
+    parser.add_argument('--cache', default = geocoder.CACHE_FN)
+    parser.add_argument('--base_url', default = geocoder.GOOGLE_URL)
+    args = parser.parse_args()
+
+    go(args.addresses, args.output, args.remote, args.geocoded, args.reference, args.keys, args.cache,
+       args.base_url)
@@ -0,0 +1,371 @@
+"""
+Point-in-polygon over GeoJSON boundaries (city limits, police beats, census
+tracts) with NumPy, and a resolver for geocodes with several candidates.
+
+Every ring of every polygon is flattened into one edge array. A batch of
+points is paired with the polygons whose bounding box holds it, each pair
+is expanded to that polygon's edges, and the even-odd rule counts the edges
+a ray from the point crosses, so holes and multipolygons need nothing extra.
+For millions of points (every 311 call against every tract) build_grid
+rasterizes the polygons first, so most points are answered by a cell lookup
+and the rest only test the few edges in their cell.
+
+resolve_ambiguous scores each candidate of an ambiguous geocode: inside
+Chicago, inside the beat recorded on the allegation, inside a tract. The
+best candidate per allegation wins; allegations whose tied best candidates
+are in different tracts (or different places, without tracts), or that have
+no candidate in the city, are the only ones left unresolved.
+"""
+
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from locations import candidate_locations, read_locations
+
+BATCH_SIZE = 2000
+# cells per side of the lookup grid over all the polygons
+GRID_SIZE = 256
+
+IN_CITY_SCORE = 4
+BEAT_SCORE = 2
+TRACT_SCORE = 1
+
+
+def geometry_rings(geometry):
+    '''(n, 2) lng/lat arrays for every ring of a GeoJSON Polygon or MultiPolygon, None for anything else'''
+    if geometry is None:
+        return None
+    if geometry['type'] == 'Polygon':
+        parts = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        parts = geometry['coordinates']
+    else:
+        return None
+    return [np.asarray(ring, dtype = np.float64)[:, :2] for part in parts for ring in part]
+
+
+def geojson_polygons(fn, id_property = None):
+    '''
+    Returns (ids, polygons) from a GeoJSON FeatureCollection: the feature's
+    id_property (or its position), and a list of ring arrays per feature
+    '''
+    with open(fn) as f:
+        features = json.load(f)['features']
+    ids, polygons = [], []
+    for i, feature in enumerate(features):
+        rings = geometry_rings(feature['geometry'])
+        if rings is None:
+            continue
+        ids.append(feature['properties'][id_property] if id_property else i)
+        polygons.append(rings)
+    return ids, polygons
+
+
+class PolygonSet(object):
+    '''Polygons flattened into edge arrays with a bounding box per polygon'''
+
+    def __init__(self, ids, polygons):
+        self.ids = np.asarray(ids, dtype = object)
+        x1, y1, x2, y2, counts = [], [], [], [], []
+        boxes = []
+        for rings in polygons:
+            n = 0
+            for ring in rings:
+                # close the ring if the file didn't
+                if len(ring) and not np.array_equal(ring[0], ring[-1]):
+                    ring = np.vstack([ring, ring[:1]])
+                x1.append(ring[:-1, 0])
+                y1.append(ring[:-1, 1])
+                x2.append(ring[1:, 0])
+                y2.append(ring[1:, 1])
+                n += len(ring) - 1
+            counts.append(n)
+            points = np.vstack(rings)
+            boxes.append((points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()))
+        self.x1 = np.concatenate(x1)
+        self.y1 = np.concatenate(y1)
+        self.x2 = np.concatenate(x2)
+        self.y2 = np.concatenate(y2)
+        self.edge_count = np.asarray(counts, dtype = np.int64)
+        self.edge_start = np.cumsum(self.edge_count) - self.edge_count
+        self.boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+        self.grid = None
+
+    @classmethod
+    def from_geojson(cls, fn, id_property = None, grid_size = None):
+        polygons = cls(*geojson_polygons(fn, id_property))
+        if grid_size:
+            polygons.build_grid(grid_size)
+        return polygons
+
+    def box_pairs(self, x, y):
+        '''(point, polygon) pairs where the point is inside the polygon's bounding box'''
+        inside = ((x[:, None] >= self.boxes[:, 0]) & (x[:, None] <= self.boxes[:, 2]) &
+                  (y[:, None] >= self.boxes[:, 1]) & (y[:, None] <= self.boxes[:, 3]))
+        return np.nonzero(inside)
+
+    def contains_pairs(self, x, y, points, polygons):
+        '''Whether point x[points[i]], y[points[i]] is inside polygon polygons[i], for every pair'''
+        counts = self.edge_count[polygons]
+        offsets = np.cumsum(counts) - counts
+        pairs = np.repeat(np.arange(len(points)), counts)
+        edges = np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(self.edge_start[polygons], counts)
+
+        px = x[points][pairs]
+        py = y[points][pairs]
+        x1, y1, x2, y2 = self.x1[edges], self.y1[edges], self.x2[edges], self.y2[edges]
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            crossing = straddles & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+        return np.bincount(pairs[crossing], minlength = len(points)) % 2 == 1
+
+    def cell_ranges(self, x0, y0, x1, y1):
+        '''First and last grid column and row overlapped by each box'''
+        g = self.grid
+        ix0 = np.clip(np.floor((x0 - g['x0']) / g['dx']), 0, g['nx'] - 1).astype(np.int64)
+        ix1 = np.clip(np.floor((x1 - g['x0']) / g['dx']), 0, g['nx'] - 1).astype(np.int64)
+        iy0 = np.clip(np.floor((y0 - g['y0']) / g['dy']), 0, g['ny'] - 1).astype(np.int64)
+        iy1 = np.clip(np.floor((y1 - g['y0']) / g['dy']), 0, g['ny'] - 1).astype(np.int64)
+        return ix0, ix1, iy0, iy1
+
+    def cells_covered(self, x0, y0, x1, y1):
+        '''(box, cell) pairs for every grid cell each box overlaps'''
+        ix0, ix1, iy0, iy1 = self.cell_ranges(x0, y0, x1, y1)
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        counts = nx * ny
+        boxes = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = ix0[boxes] + k // ny[boxes]
+        cy = iy0[boxes] + k % ny[boxes]
+        return boxes, cx * self.grid['ny'] + cy
+
+    def build_grid(self, grid_size = GRID_SIZE):
+        '''
+        Rasterizes the polygons onto a grid_size x grid_size grid. Every cell
+        keeps the polygons containing its centre and the edges whose bounding
+        box overlaps it. Cells no edge reaches are inside or outside every
+        polygon as a whole; in the others a point is inside a polygon when
+        the centre is and the segment between them crosses an even number
+        of that polygon's edges, so only edges in the cell are ever tested.
+        '''
+        x0, y0 = self.boxes[:, 0].min(), self.boxes[:, 1].min()
+        x1, y1 = self.boxes[:, 2].max(), self.boxes[:, 3].max()
+        self.grid = None
+        grid = {'x0': x0, 'y0': y0, 'nx': grid_size, 'ny': grid_size,
+                'dx': (x1 - x0) / grid_size or 1.0, 'dy': (y1 - y0) / grid_size or 1.0}
+        n_cells = grid_size * grid_size
+        cells = np.arange(n_cells)
+        grid['cx'] = x0 + (cells // grid_size + 0.5) * grid['dx']
+        grid['cy'] = y0 + (cells % grid_size + 0.5) * grid['dy']
+
+        # polygons containing each centre, from the bounding box search
+        centres, polygons = [], []
+        for start in range(0, n_cells, BATCH_SIZE):
+            batch = slice(start, start + BATCH_SIZE)
+            points, candidates = self.box_pairs(grid['cx'][batch], grid['cy'][batch])
+            inside = self.contains_pairs(grid['cx'][batch], grid['cy'][batch], points, candidates)
+            centres.append(points[inside] + start)
+            polygons.append(candidates[inside])
+        # one sorted key per (cell, polygon) pair
+        grid['inside'] = np.sort(np.concatenate(centres) * len(self.ids) + np.concatenate(polygons))
+        grid['answer'] = np.full(n_cells, -1, dtype = np.int64)
+        # first key per cell is its lowest-numbered polygon
+        first = np.unique(grid['inside'] // len(self.ids), return_index = True)
+        grid['answer'][first[0]] = grid['inside'][first[1]] % len(self.ids)
+
+        self.grid = grid
+        edges, cells = self.cells_covered(np.minimum(self.x1, self.x2), np.minimum(self.y1, self.y2),
+                                          np.maximum(self.x1, self.x2), np.maximum(self.y1, self.y2))
+        order = np.argsort(cells, kind = 'mergesort')
+        grid['edges'] = edges[order]
+        grid['edge_start'] = np.searchsorted(cells[order], np.arange(n_cells + 1))
+        grid['crossed'] = grid['edge_start'][1:] > grid['edge_start'][:-1]
+        grid['edge_polygon'] = np.repeat(np.arange(len(self.ids)), self.edge_count)
+
+    def locate_in_cells(self, x, y, cells):
+        '''Lowest-numbered polygon containing each point, testing only the edges in its cell'''
+        g = self.grid
+        n = len(self.ids)
+        counts = g['edge_start'][cells + 1] - g['edge_start'][cells]
+        points = np.repeat(np.arange(len(x)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        edges = g['edges'][np.repeat(g['edge_start'][cells], counts) + k]
+
+        px, py = x[points], y[points]
+        rx, ry = g['cx'][cells][points], g['cy'][cells][points]
+        x1, y1, x2, y2 = self.x1[edges], self.y1[edges], self.x2[edges], self.y2[edges]
+        # the edge's ends on either side of the point-centre line (a vertex on
+        # the line counts as below it, so touching at a vertex crosses 0 or 2 times)...
+        a_side = (rx - px) * (y1 - py) - (ry - py) * (x1 - px) > 0
+        b_side = (rx - px) * (y2 - py) - (ry - py) * (x2 - px) > 0
+        # ...and the point and centre on either side of the edge
+        p_side = (x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)
+        r_side = (x2 - x1) * (ry - y1) - (y2 - y1) * (rx - x1)
+        crossing = (a_side != b_side) & (p_side * r_side < 0)
+
+        keys, crossings = np.unique(points[crossing] * n + g['edge_polygon'][edges[crossing]], return_counts = True)
+        flipped = keys[crossings % 2 == 1]
+        # (point, polygon) keys for the polygons around each centre
+        lo = np.searchsorted(g['inside'], cells * n)
+        hi = np.searchsorted(g['inside'], (cells + 1) * n)
+        counts = hi - lo
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        centre = np.repeat(np.arange(len(x)), counts) * n + g['inside'][np.repeat(lo, counts) + k] % n
+        inside = np.setxor1d(centre, flipped)
+
+        found = np.full(len(x), -1, dtype = np.int64)
+        first = np.unique(inside // n, return_index = True)
+        found[first[0]] = inside[first[1]] % n
+        return found
+
+    def locate_grid(self, x, y):
+        g = self.grid
+        found = np.full(len(x), -1, dtype = np.int64)
+        ix = np.floor((x - g['x0']) / g['dx'])
+        iy = np.floor((y - g['y0']) / g['dy'])
+        # points on the far edge belong to the last cell
+        ix[x == g['x0'] + g['nx'] * g['dx']] = g['nx'] - 1
+        iy[y == g['y0'] + g['ny'] * g['dy']] = g['ny'] - 1
+        on_grid = (ix >= 0) & (ix < g['nx']) & (iy >= 0) & (iy < g['ny'])
+        cells = np.where(on_grid, ix * g['ny'] + iy, 0).astype(np.int64)
+        found[on_grid] = g['answer'][cells[on_grid]]
+        crossed = on_grid & g['crossed'][cells]
+        found[crossed] = self.locate_in_cells(x[crossed], y[crossed], cells[crossed])
+        return found
+
+    def locate(self, x, y, batch_size = BATCH_SIZE):
+        '''
+        Position of the (first) polygon containing each point, -1 for none.
+        Uses the grid when build_grid has been called, bounding boxes otherwise.
+        '''
+        x = np.asarray(x, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+        found = np.full(len(x), -1, dtype = np.int64)
+        for start in range(0, len(x), batch_size):
+            batch = slice(start, start + batch_size)
+            if self.grid is not None:
+                found[batch] = self.locate_grid(x[batch], y[batch])
+                continue
+            points, polygons = self.box_pairs(x[batch], y[batch])
+            inside = self.contains_pairs(x[batch], y[batch], points, polygons)
+            # reversed so the first polygon listed wins where they overlap
+            found[batch][points[inside][::-1]] = polygons[inside][::-1]
+        return found
+
+    def ids_at(self, x, y, batch_size = BATCH_SIZE):
+        '''Id of the polygon containing each point, None for none'''
+        found = self.locate(x, y, batch_size)
+        ids = np.full(len(found), None, dtype = object)
+        ids[found >= 0] = self.ids[found[found >= 0]]
+        return ids
+
+
+def count_by_polygon(points, polygons, batch_size = BATCH_SIZE):
+    '''
+    Takes a dict of name -> (lng, lat) arrays and returns a frame indexed by
+    polygon id with a count of each name's points per polygon, locating all
+    the points in one pass
+    '''
+    names = list(points)
+    x = np.concatenate([np.asarray(points[name][0], dtype = np.float64) for name in names])
+    y = np.concatenate([np.asarray(points[name][1], dtype = np.float64) for name in names])
+    codes = np.repeat(np.arange(len(names)), [len(points[name][0]) for name in names])
+    found = polygons.locate(x, y, batch_size)
+    tagged = found >= 0
+    counts = np.bincount(found[tagged] * len(names) + codes[tagged], minlength = len(polygons.ids) * len(names))
+    return pd.DataFrame(counts.reshape(len(polygons.ids), len(names)), index = polygons.ids, columns = names)
+
+
+def same_ids(a, b):
+    '''Elementwise id equality that ignores '0123' vs 123 formatting'''
+    a = pd.to_numeric(pd.Series(a), errors = 'coerce').values
+    b = pd.to_numeric(pd.Series(b), errors = 'coerce').values
+    return (a == b) & ~np.isnan(a)
+
+
+def score_candidates(candidates, boundary = None, beats = None, tracts = None):
+    '''
+    Adds in_city, beat_match, tractce10 and score columns to a candidates
+    frame (lat, lng and the allegation's beat). Polygon sets left as None
+    don't count.
+    '''
+    out = candidates.copy()
+    lng, lat = out.lng.values, out.lat.values
+    out['score'] = 0
+    out['in_city'] = boundary.locate(lng, lat) >= 0 if boundary is not None else True
+    out['score'] += IN_CITY_SCORE * out.in_city
+    if beats is not None:
+        out['beat_match'] = same_ids(beats.ids_at(lng, lat), out.beat.values)
+        out['score'] += BEAT_SCORE * out.beat_match
+    out['tractce10'] = tracts.ids_at(lng, lat) if tracts is not None else None
+    if tracts is not None:
+        out['score'] += TRACT_SCORE * out.tractce10.notnull()
+    return out
+
+
+def resolve_ambiguous(geocoded, boundary = None, beats = None, tracts = None):
+    '''
+    Picks a candidate for every row of geocoded (crid, address, geocode and
+    optionally beat, as read by locations.read_locations). Returns
+    (resolved, unresolved): crid, lat, lng, tractce10, score for the rows
+    with a clear best candidate and crid, address for the rest.
+    '''
+    geocoded = geocoded.reset_index()
+    candidates = candidate_locations(geocoded.geocode)
+    candidates['beat'] = geocoded.beat.values[candidates.row.values] if 'beat' in geocoded.columns else np.nan
+    scored = score_candidates(candidates, boundary, beats, tracts)
+
+    # best first, Google's own order breaking ties
+    scored = scored.sort_values(['row', 'score', 'rank'], ascending = [True, False, True])
+    top = scored[scored.score == scored.groupby('row').score.transform('max')]
+    if tracts is not None:
+        place = top.tractce10.astype(str)
+    else:
+        place = top.lat.round(4).astype(str) + ',' + top.lng.round(4).astype(str)
+    places = place.groupby(top.row).nunique()
+    best = top.drop_duplicates('row').set_index('row')
+    clear = best.index[(places.reindex(best.index) == 1).values & best.in_city.values.astype(bool)]
+
+    resolved = best.loc[clear, ['lat', 'lng', 'tractce10', 'score']]
+    resolved.insert(0, 'crid', geocoded.crid.values[clear])
+    unresolved = geocoded.loc[~geocoded.index.isin(clear), ['crid', 'address']]
+    return resolved.reset_index(drop = True), unresolved
+
+
+def load_polygons(boundary_fn = None, beats_fn = None, tracts_fn = None, beat_property = 'beat_num',
+                  tract_property = 'tractce10'):
+    '''PolygonSets for whichever of the GeoJSON files are given'''
+    return (PolygonSet.from_geojson(boundary_fn) if boundary_fn else None,
+            PolygonSet.from_geojson(beats_fn, beat_property) if beats_fn else None,
+            PolygonSet.from_geojson(tracts_fn, tract_property) if tracts_fn else None)
+
+
+def read_beats(allegations_fn):
+    '''crid -> beat from a csv of allegations'''
+    return pd.read_csv(allegations_fn, usecols = ['crid', 'beat']).drop_duplicates('crid').set_index('crid')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Pick the best candidate for geocodes with several results')
+    parser.add_argument('geocoded', help = 'crid, address, geocode csv from the geocoder')
+    parser.add_argument('resolved')
+    parser.add_argument('unresolved')
+    parser.add_argument('--allegations', help = 'csv with crid and beat')
+    parser.add_argument('--boundary', help = 'GeoJSON of the city limits')
+    parser.add_argument('--beats', help = 'GeoJSON of the police beats')
+    parser.add_argument('--tracts', help = 'GeoJSON of the 2010 census tracts')
+    parser.add_argument('--beat_property', default = 'beat_num')
+    parser.add_argument('--tract_property', default = 'tractce10')
+    args = parser.parse_args()
+
+    geocoded = read_locations(args.geocoded)
+    if args.allegations:
+        geocoded = geocoded.join(read_beats(args.allegations), how = 'left')
+    resolved, unresolved = resolve_ambiguous(
+        geocoded, *load_polygons(args.boundary, args.beats, args.tracts, args.beat_property, args.tract_property))
+    print('{} resolved, {} unresolved'.format(len(resolved), len(unresolved)))
+    resolved.to_csv(args.resolved, index = False)
+    unresolved.to_csv(args.unresolved, index = False)
@@ -0,0 +1,71 @@
+'''
+Checks polygons.py's grid lookup against the bounding box search and a
+plain ray-casting loop over every polygon. Run with
+python -m pytest geocoding.
+'''
+
+import numpy as np
+
+from polygons import PolygonSet, count_by_polygon
+
+
+def star(cx, cy, r, n, rng):
+    '''A ring around (cx, cy) with n vertices at random radii, so plenty of concave edges'''
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+    radii = r * rng.uniform(0.3, 1.0, n)
+    return np.column_stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)])
+
+
+def random_polygons(seed = 0):
+    '''Overlapping stars, one with a hole and one in two parts'''
+    rng = np.random.RandomState(seed)
+    polygons = [[star(rng.uniform(0, 10), rng.uniform(0, 10), rng.uniform(1, 3), 30, rng)] for _ in range(12)]
+    polygons.append([star(5, 5, 3, 40, rng), star(5, 5, 0.2, 8, rng)])
+    polygons.append([star(1, 9, 1, 12, rng), star(9, 1, 1, 12, rng)])
+    return ['p{}'.format(i) for i in range(len(polygons))], polygons
+
+
+def inside_ring(x, y, ring):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis = 0)):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def brute_force(x, y, polygons):
+    '''First polygon (even-odd over all its rings) containing each point, -1 for none'''
+    found = []
+    for px, py in zip(x, y):
+        hits = [i for i, rings in enumerate(polygons)
+                if sum(inside_ring(px, py, ring) for ring in rings) % 2 == 1]
+        found.append(hits[0] if hits else -1)
+    return np.array(found)
+
+
+def test_grid_matches_bounding_boxes_and_brute_force():
+    ids, polygons = random_polygons()
+    rng = np.random.RandomState(1)
+    # some points off the grid entirely
+    x, y = rng.uniform(-2, 12, 3000), rng.uniform(-2, 12, 3000)
+
+    boxes = PolygonSet(ids, polygons).locate(x, y, batch_size = 700)
+    for grid_size in [1, 7, 64]:
+        gridded = PolygonSet(ids, polygons)
+        gridded.build_grid(grid_size)
+        np.testing.assert_array_equal(gridded.locate(x, y, batch_size = 700), boxes)
+    np.testing.assert_array_equal(boxes[:500], brute_force(x[:500], y[:500], polygons))
+
+
+def test_counts_by_polygon():
+    ids, polygons = random_polygons(seed = 2)
+    tracts = PolygonSet(ids, polygons)
+    tracts.build_grid(32)
+    rng = np.random.RandomState(3)
+    a = (rng.uniform(0, 10, 500), rng.uniform(0, 10, 500))
+    b = (rng.uniform(0, 10, 200), rng.uniform(0, 10, 200))
+    counts = count_by_polygon({'a': a, 'b': b}, tracts)
+    assert list(counts.index) == ids
+    for name, (x, y) in [('a', a), ('b', b)]:
+        expected = np.bincount(brute_force(x, y, polygons) + 1, minlength = len(ids) + 1)[1:]
+        np.testing.assert_array_equal(counts[name].values, expected)
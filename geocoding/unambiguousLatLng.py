@@ -1,25 +1,10 @@
-import pandas as pd
-import ast
 import sys
 
-def go(fn):
-    df = pd.read_csv(fn, index_col = 0)
-
-    def latfunc(x):
-        dic = ast.literal_eval(x)[0]
-        lat = dic['geometry']['location']['lat']
-        return lat
-
-    def lngfunc(x):
-        dic = ast.literal_eval(x)[0]
-        lng = dic['geometry']['location']['lng']
-        return lng
+from locations import read_locations
 
-    df_final = pd.DataFrame(index = df.index)
-    df_final["lat"] = df.geocode.apply(latfunc)
-    df_final["lng"] = df.geocode.apply(lngfunc)
-
-    df_final.to_csv("unambiguousResolved2.csv")
+def go(fn):
+    df = read_locations(fn)
+    df[["lat", "lng"]].to_csv("unambiguousResolved2.csv")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+"""
+Prepared dataset layer for pipeline.py. Parses a feature CSV (or a
+feather/parquet file from final_data's --format option) once into a
+float32 feature matrix, a label vector and a column index, sorted by
+dateobj so temporal folds are contiguous row ranges.
+
+Stage files written with --sparse keep their dummy columns in a CSR .npz
+next to the csv. Those are loaded as a separate sparse block, so only the
+numeric columns are ever held densely.
+
+Prepared arrays are cached under cache/datasets/<hash>/ as .npy files,
+keyed by the CSV's contents plus the label and dropped columns, and are
+memory-mapped on later runs instead of re-parsing the CSV.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+CACHE_DIR = os.path.join('cache', 'datasets')
+DATE_COL = 'dateobj'
+
+
+def file_hash(path, block_size=2 ** 20):
+    '''
+    Returns the sha1 hex digest of a file's contents.
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_frame(fn):
+    '''
+    Reads a stage file by extension: feather and parquet keep the dtypes
+    written by final_data's --format option, anything else is parsed as csv.
+    '''
+    extension = os.path.splitext(fn)[1].lower()
+    if extension == '.feather':
+        return pd.read_feather(fn)
+    if extension == '.parquet':
+        return pd.read_parquet(fn)
+    return pd.read_csv(fn)
+
+
+def dummy_paths(csv_fn):
+    '''
+    Returns the CSR .npz and json column manifest written next to a stage
+    file by final_data's --sparse option.
+    '''
+    base = os.path.splitext(csv_fn)[0]
+    return base + '.dummies.npz', base + '.dummies.json'
+
+
+def save_matrix(base, matrix):
+    '''
+    Saves a dense array as base.npy, or a CSR matrix as base.data.npy,
+    base.indices.npy and base.indptr.npy.
+    Returns a json-able description needed by load_matrix.
+    '''
+    if sp.issparse(matrix):
+        matrix = matrix.tocsr()
+        for part in ['data', 'indices', 'indptr']:
+            np.save('{}.{}.npy'.format(base, part), getattr(matrix, part))
+        return {'sparse': True, 'shape': list(matrix.shape)}
+    np.save(base + '.npy', matrix)
+    return {'sparse': False}
+
+
+def load_matrix(base, description, mmap_mode='r'):
+    '''
+    Memory-maps a matrix written by save_matrix.
+    '''
+    if description['sparse']:
+        parts = [np.load('{}.{}.npy'.format(base, part), mmap_mode=mmap_mode)
+                 for part in ['data', 'indices', 'indptr']]
+        return sp.csr_matrix(tuple(parts), shape=tuple(description['shape']), copy=False)
+    return np.load(base + '.npy', mmap_mode=mmap_mode)
+
+
+class PreparedDataset(object):
+    '''
+    Feature matrix X (float32, rows sorted by date), label vector y and the
+    list of feature column names. In sparse mode X holds only the numeric
+    columns and dummies the CSR dummy block; columns lists both, numeric
+    first.
+    '''
+
+    def __init__(self, X, y, columns, label, dummies=None, key=None, path=None):
+        self.X = X
+        self.y = y
+        self.columns = pd.Index(columns)
+        self.label = label
+        self.dummies = dummies
+        self.key = key
+        self.path = path
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            # pickle a reference to the .npy files rather than the arrays
+            del state['X'], state['y'], state['dummies']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            loaded = PreparedDataset.load(self.path)
+            self.X, self.y, self.dummies = loaded.X, loaded.y, loaded.dummies
+
+    def chunk_bounds(self, n=5):
+        '''
+        Returns the n + 1 row offsets splitting the rows into n temporal
+        chunks, matching np.array_split.
+        '''
+        sizes = [len(a) for a in np.array_split(np.arange(len(self)), n)]
+        return np.concatenate([[0], np.cumsum(sizes)])
+
+    def save(self, path):
+        '''
+        Writes X, y, the dummy block and the column index to path as
+        .npy/.json files. The json is written last, so a partial write is
+        never loaded.
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'X.npy'), self.X)
+        np.save(os.path.join(path, 'y.npy'), self.y)
+        dummies = None
+        if self.dummies is not None:
+            dummies = save_matrix(os.path.join(path, 'dummies'), self.dummies)
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump({'columns': list(self.columns), 'label': self.label,
+                       'dummies': dummies}, f)
+        self.path = path
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Memory-maps a dataset previously written with save.
+        '''
+        X = np.load(os.path.join(path, 'X.npy'), mmap_mode=mmap_mode)
+        y = np.load(os.path.join(path, 'y.npy'), mmap_mode=mmap_mode)
+        with open(os.path.join(path, 'columns.json')) as f:
+            meta = json.load(f)
+        dummies = None
+        if meta.get('dummies'):
+            dummies = load_matrix(os.path.join(path, 'dummies'), meta['dummies'], mmap_mode)
+        return cls(X, y, meta['columns'], meta['label'], dummies=dummies,
+                   key=os.path.basename(path), path=path)
+
+
+def load_dummies(csv_fn):
+    '''
+    Returns the CSR dummy block and its column names for a stage csv
+    written with --sparse.
+    '''
+    npz_fn, manifest_fn = dummy_paths(csv_fn)
+    npz = np.load(npz_fn)
+    dummies = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                            shape=tuple(npz['shape']))
+    with open(manifest_fn) as f:
+        columns = json.load(f)['columns']
+    return dummies.astype(np.float32), columns
+
+
+def prepare(df, label, to_drop=(), dummies=None, dummy_columns=()):
+    '''
+    Takes the raw feature DataFrame, and optionally a sparse dummy block
+    with one row per row of df. Drops to_drop columns that exist, sorts
+    by date and splits off the label.
+    Returns a PreparedDataset.
+    '''
+    df = df.drop([col for col in to_drop if col in df.columns], axis=1)
+    # CSVs read without parse_dates leave dates as strings (NaN when
+    # missing), so parse first; missing dates sort last, ties keep file order
+    dates = pd.to_datetime(df[DATE_COL], errors='coerce').reset_index(drop=True)
+    order = dates.sort_values(kind='mergesort', na_position='last').index.values
+    df = df.iloc[order]
+    y = df[label].values
+    features = df.drop([label, DATE_COL], axis=1)
+
+    non_numeric = features.select_dtypes(exclude=[np.number, bool]).columns
+    if len(non_numeric):
+        raise ValueError('Non-numeric feature columns: {}'.format(list(non_numeric)))
+
+    X = np.ascontiguousarray(features.values, dtype=np.float32)
+    columns = list(features.columns)
+    if dummies is not None:
+        dummies = dummies[order]
+        columns += list(dummy_columns)
+    return PreparedDataset(X, y, columns, label, dummies=dummies)
+
+
+def load_dataset(csv_fn, label, to_drop=(), cache_dir=CACHE_DIR, use_cache=True):
+    '''
+    Returns the PreparedDataset for csv_fn, parsing the CSV only when no
+    cached copy exists for this file content, label and drop list. A CSR
+    dummy block next to the csv is picked up automatically.
+    '''
+    npz_fn, manifest_fn = dummy_paths(csv_fn)
+    sparse = os.path.exists(npz_fn) and os.path.exists(manifest_fn)
+
+    sha = hashlib.sha1()
+    sha.update(file_hash(csv_fn).encode('utf-8'))
+    if sparse:
+        sha.update(file_hash(npz_fn).encode('utf-8'))
+    sha.update(json.dumps([label, sorted(to_drop)]).encode('utf-8'))
+    key = sha.hexdigest()
+    path = os.path.join(cache_dir, key)
+
+    if use_cache and os.path.exists(os.path.join(path, 'columns.json')):
+        print("Loading prepared dataset from {}".format(path))
+        return PreparedDataset.load(path)
+
+    print("Parsing {}".format(csv_fn))
+    dummies, dummy_columns = load_dummies(csv_fn) if sparse else (None, ())
+    dataset = prepare(read_frame(csv_fn), label, to_drop, dummies, dummy_columns)
+    dataset.key = key
+    if use_cache:
+        dataset.save(path)
+        # reopen memory-mapped so worker processes share the page cache
+        return PreparedDataset.load(path)
+    return dataset
@@ -0,0 +1,197 @@
+"""
+Builds the temporal cross validation folds for pipeline.py from a
+PreparedDataset. Rows are already sorted by date, so each of the temporal
+chunks is a row range and a fold's train/test sets are slices of the
+dataset matrix rather than concatenated copies.
+
+Imputed fold matrices are computed once per process and reused by every
+parameter set and oversampler that runs on that fold. share() instead
+computes them once in the parent and memory-maps them from .npy files, so
+worker processes (ours, or joblib's for n_jobs=-1) attach to the same
+pages rather than each holding a private copy.
+
+For sparse datasets, imputation only touches the dense numeric block and
+the dummy block is appended as CSR afterwards. Estimators and oversamplers
+that need dense input get dense_fold(), converted once per process per fold.
+"""
+
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+import scipy.sparse as sp
+
+from dataset import save_matrix, load_matrix
+
+
+def impute(X_train, X_test, mean_cols, columns=None):
+    '''
+    Fills missing values with the (rounded) train mean for the mean_cols
+    column indices and with 0 everywhere else, in one vectorized pass.
+    Arrays without missing values are returned as-is, without a copy.
+    '''
+    fill = np.zeros(X_train.shape[1], dtype=X_train.dtype)
+    if len(mean_cols):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            means = np.round(np.nanmean(X_train[:, mean_cols], axis=0))
+        if np.isnan(means).any():
+            empty = np.asarray(mean_cols)[np.isnan(means)]
+            if columns is not None:
+                empty = columns[empty]
+            print('No train values to take the mean of, filling with 0: {}'.format(list(empty)))
+            means[np.isnan(means)] = 0
+        fill[mean_cols] = means
+    return _fill_missing(X_train, fill), _fill_missing(X_test, fill)
+
+
+def _fill_missing(X, fill):
+    rows, cols = np.where(np.isnan(X))
+    if not len(rows):
+        return X
+    X = np.array(X)
+    X[rows, cols] = fill[cols]
+    return X
+
+
+class FoldBuilder(object):
+    '''
+    Hands out (X_train, y_train, X_test, y_test) for each fold, where the
+    train set of fold i is the union of chunks train_split[i] and the test
+    set is chunk test_split[i].
+    '''
+
+    def __init__(self, dataset, train_split, test_split, fill_with_mean, n_chunks=5):
+        self.dataset = dataset
+        self.train_split = train_split
+        self.test_split = test_split
+        self.bounds = dataset.chunk_bounds(n_chunks)
+        self.mean_cols = [i for i, col in enumerate(dataset.columns)
+                          if col in fill_with_mean]
+        self._folds = {}
+        self._dense = {}
+        self.shared_dir = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # dense copies are rebuilt where they are needed, not shipped to workers
+        state['_dense'] = {}
+        if self.shared_dir is not None:
+            # workers re-open the memory-mapped files instead of getting copies
+            state['_folds'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_dir is not None:
+            self.share(self.shared_dir)
+
+    def __len__(self):
+        return len(self.train_split)
+
+    def key(self):
+        '''
+        Returns a hash identifying these folds: the dataset, the splits,
+        the columns imputed with their mean and whether X is sparse.
+        '''
+        description = json.dumps([self.dataset.key, self.train_split, self.test_split,
+                                  [int(i) for i in self.mean_cols], len(self.bounds) - 1,
+                                  self.dataset.dummies is not None])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def rows(self, chunk_ids):
+        '''
+        Returns a slice over the rows of the given chunks when they are
+        adjacent (always the case for the window and tack-one-on splits),
+        otherwise an index array.
+        '''
+        chunk_ids = sorted(chunk_ids)
+        if chunk_ids == list(range(chunk_ids[0], chunk_ids[-1] + 1)):
+            return slice(self.bounds[chunk_ids[0]], self.bounds[chunk_ids[-1] + 1])
+        return np.concatenate([np.arange(self.bounds[c], self.bounds[c + 1])
+                               for c in chunk_ids])
+
+    def raw_fold(self, fold):
+        '''
+        Returns the un-imputed train/test arrays for fold, as views into
+        the dataset wherever the rows are contiguous. In sparse mode these
+        are the numeric columns only.
+        '''
+        train_rows = self.rows(self.train_split[fold])
+        test_rows = self.rows([self.test_split[fold]])
+        X, y = self.dataset.X, self.dataset.y
+        return X[train_rows], y[train_rows], X[test_rows], y[test_rows]
+
+    def fold(self, fold):
+        '''
+        Returns the imputed (X_train, y_train, X_test, y_test) for fold,
+        computing it on first use. In sparse mode the X matrices are CSR,
+        with the imputed numeric columns followed by the dummy block.
+        '''
+        if fold not in self._folds:
+            X_train, y_train, X_test, y_test = self.raw_fold(fold)
+            X_train, X_test = impute(X_train, X_test, self.mean_cols,
+                                     self.dataset.columns)
+            dummies = self.dataset.dummies
+            if dummies is not None:
+                train_rows = self.rows(self.train_split[fold])
+                test_rows = self.rows([self.test_split[fold]])
+                X_train = sp.hstack([sp.csr_matrix(X_train), dummies[train_rows]], format='csr')
+                X_test = sp.hstack([sp.csr_matrix(X_test), dummies[test_rows]], format='csr')
+            self._folds[fold] = (X_train, y_train, X_test, y_test)
+        return self._folds[fold]
+
+    def dense_fold(self, fold):
+        '''
+        Returns fold with dense X matrices, for estimators and oversamplers
+        that can't take CSR input. The conversion is done once per process
+        and reused by every task on the fold.
+        '''
+        X_train, y_train, X_test, y_test = self.fold(fold)
+        if not sp.issparse(X_train):
+            return X_train, y_train, X_test, y_test
+        if fold not in self._dense:
+            self._dense[fold] = (X_train.toarray(), y_train, X_test.toarray(), y_test)
+        return self._dense[fold]
+
+    def share(self, directory):
+        '''
+        Writes every imputed fold matrix that is not already a view of the
+        memory-mapped dataset to directory as .npy, and memory-maps it
+        read-only. Folds already written to directory are reused.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = ['X_train', 'y_train', 'X_test', 'y_test']
+        for fold in range(len(self)):
+            # describes the matrices written for this fold; written last
+            manifest = os.path.join(directory, 'fold{}.json'.format(fold))
+            if os.path.exists(manifest):
+                with open(manifest) as f:
+                    saved = json.load(f)
+                arrays = self.raw_fold(fold)
+            else:
+                arrays = self.fold(fold)
+                saved = {}
+                for name, array in zip(names, arrays):
+                    if not self._is_shared(array):
+                        base = os.path.join(directory, 'fold{}_{}'.format(fold, name))
+                        saved[name] = save_matrix(base, array)
+                with open(manifest, 'w') as f:
+                    json.dump(saved, f)
+
+            self._folds[fold] = tuple(
+                load_matrix(os.path.join(directory, 'fold{}_{}'.format(fold, name)),
+                            saved[name]) if name in saved else array
+                for name, array in zip(names, arrays))
+        self.shared_dir = directory
+
+    def _is_shared(self, array):
+        '''
+        True if array is a view into the dataset's memory-mapped files.
+        '''
+        return (self.dataset.path is not None and not sp.issparse(array) and
+                (np.may_share_memory(array, self.dataset.X) or
+                 np.may_share_memory(array, self.dataset.y)))
@@ -11,16 +11,18 @@ from sklearn.cross_validation import train_test_split
 from sklearn.grid_search import ParameterGrid, GridSearchCV
 from sklearn.metrics import *
 from sklearn.preprocessing import StandardScaler
+from sklearn.base import clone
 import sklearn.feature_selection
 import sklearn.pipeline
 
 #All other libraries
-import argparse, sys, pickle, random, time, json, datetime, itertools, csv
+import argparse, os, sys, pickle, random, time, json, datetime, itertools, csv
 import pandas as pd
 import numpy as np
 # matplotlib.use('Agg') # enable plots to be saved on Ubuntu VM
 import pylab as pl
 from scipy import optimize
+import scipy.sparse
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.style.use('ggplot')
@@ -30,6 +32,11 @@ from unbalanced_dataset.over_sampling import RandomOverSampler
 from unbalanced_dataset.over_sampling import SMOTE
 from unbalanced_dataset.combine import SMOTETomek
 from unbalanced_dataset.combine import SMOTEENN
+from scheduler import build_tasks, run_tasks, resolve_workers
+from dataset import load_dataset
+from folds import FoldBuilder
+from results_cache import ResultCache, canonical
+from search import successive_halving
 
 
 '''
@@ -48,6 +55,16 @@ TEST_SPLITS_TACK = [2,3,4]
 TO_DROP = ['crid', 'officer_id', 'index', 'Unnamed: 0']
 FILL_WITH_MEAN = ['officers_age', 'transit_time', 'car_time','agesqrd','complainant_age']
 
+#estimators that can be fit on the CSR matrices of a sparse dataset
+#(GradientBoostingClassifier and KNN's RobustScaler need dense input)
+SPARSE_MODELS = ['RF', 'AB', 'LR', 'SVM', 'DT', 'test']
+
+#ensembles whose n_estimators sweep is grown with warm_start
+WARM_START_MODELS = ['RF', 'GB']
+
+#per-process state for fold tasks, filled in by _init_worker
+WORKER_DATA = {}
+
 #estimators
 CLFS = {
         'RF': RandomForestClassifier(n_estimators=50, n_jobs=-1),
@@ -116,6 +133,13 @@ GRID = {
                 }
        }
 
+#weak learners for AdaBoost; each distinct tree becomes one base_estimator value
+AB_BASE_GRID = {
+        'criterion': ['gini', 'entropy'],
+        'max_depth': [1,3,5],
+        'class_weight': ['balanced', None]
+        }
+
 SVM_ARGS={'class_weight': 'auto'}
 OVER_SAMPLERS = {'ROS': RandomOverSampler(ratio='auto', verbose=False),
                 'SMOTE': SMOTE(ratio='auto', verbose=False, kind='regular'),
@@ -127,14 +151,6 @@ OVER_SAMPLERS = {'ROS': RandomOverSampler(ratio='auto', verbose=False),
                 'None': None
                 }
 
-def temporal_split_data(df,n=5):
-    df_sorted = df.sort_values(by='dateobj')
-    chunks = np.array_split(df_sorted, n)
-    for chunk in chunks:
-        chunk.drop('dateobj',axis=1, inplace=True)
-    return chunks
-
-
 def get_feature_importances(model):
     try:
         return model.feature_importances_
@@ -175,6 +191,22 @@ def grid_from_class(class_name):
     return grids
 
 
+def base_estimators(base_name, base_grid):
+    '''
+    Returns a distinct estimator instance for every parameter set in
+    base_grid, dropping any that end up with identical parameters.
+    '''
+    bases = []
+    seen = set()
+    for params in _generate_grid(base_grid):
+        base = clone(CLFS[base_name]).set_params(**params)
+        key = canonical(base)
+        if key not in seen:
+            seen.add(key)
+            bases.append(base)
+    return bases
+
+
 def convert_to_binary(predictions):
     print("Statistics with probability cutoff at 0.5")
     # binary predictions with some cutoff for these evaluations
@@ -187,18 +219,351 @@ def convert_to_binary(predictions):
     return predictions_binary
 
 
+def _init_worker(folds, cache, n_jobs, stage, dem_label):
+    #Data every fold task needs; set once per worker process
+    WORKER_DATA['folds'] = folds
+    WORKER_DATA['cache'] = cache
+    WORKER_DATA['n_jobs'] = n_jobs
+    WORKER_DATA['stage'] = stage
+    WORKER_DATA['dem_label'] = dem_label
+
+
+def make_pipeline(model_name, params, n_jobs=-1):
+    clf = clone(CLFS[model_name])
+    clf.set_params(**params)
+    if hasattr(clf, 'n_jobs'):
+        clf.set_params(n_jobs=n_jobs)
+
+    if model_name=='KNN':
+        steps = [("normalization", preprocessing.RobustScaler()),('feat', sklearn.feature_selection.SelectKBest(k=10)),
+         (model_name, clf)]
+    else:
+        steps = [(model_name, clf)]
+
+    return clf, sklearn.pipeline.Pipeline(steps)
+
+
+def describe_task(model_name, params, over_sampler):
+    '''
+    Full configuration of a task's pipeline and oversampler for the result
+    cache key: every parameter of the cloned estimator and its steps, so a
+    changed default in CLFS or OVER_SAMPLERS is a new cell.
+    '''
+    clf, pipeline = make_pipeline(model_name, params)
+    return canonical([model_name, pipeline, over_sampler, OVER_SAMPLERS[over_sampler]])
+
+
+def _oversample_rows(y, random_state=None):
+    '''
+    Row indices for random oversampling: every row, plus minority rows
+    drawn with replacement until the classes are balanced (what
+    RandomOverSampler(ratio='auto') does), so CSR matrices can be
+    resampled by indexing instead of densifying.
+    '''
+    rng = np.random.RandomState(random_state)
+    labels, counts = np.unique(y, return_counts=True)
+    minority = np.nonzero(y == labels[np.argmin(counts)])[0]
+    extra = rng.choice(minority, counts.max() - counts.min(), replace=True)
+    return np.concatenate([np.arange(len(y)), extra])
+
+
+def _fold_data(model_name, over_sampler, fold):
+    '''
+    Returns the (resampled) training data and the test data for a fold.
+    Sparse folds stay CSR for random oversampling and for models that take
+    CSR input; models and oversamplers that can't use the fold's cached
+    dense copy.
+    '''
+    folds = WORKER_DATA['folds']
+    print("Oversampler: {}".format(over_sampler))
+    print("Training sets are: {}".format(folds.train_split[fold]))
+    print("Testing sets are: {}".format(folds.test_split[fold]))
+
+    # train/test views for this fold, imputed once and shared by every task
+    X_train, y_train, X_test, y_test = folds.fold(fold)
+
+    os_object = OVER_SAMPLERS[over_sampler]
+    if scipy.sparse.issparse(X_train):
+        if model_name not in SPARSE_MODELS or (os_object is not None and over_sampler != 'ROS'):
+            X_train, y_train, X_test, y_test = folds.dense_fold(fold)
+        elif over_sampler == 'ROS':
+            rows = _oversample_rows(np.asarray(y_train))
+            return X_train[rows], np.asarray(y_train)[rows], X_test, y_test
+
+    # Resample minority class
+    if os_object is not None:
+        # asarray: the cached dense fold is reused by other tasks, and the oversamplers return new arrays
+        X_resampled = np.asarray(X_train)
+        y_resampled = np.asarray(y_train)
+        X_resampled, y_resampled = os_object.fit_transform(X_resampled,y_resampled)
+
+    else:
+        X_resampled = X_train
+        y_resampled = y_train
+
+    return X_resampled, y_resampled, X_test, y_test
+
+
+def _evaluate(task, clf, pipeline, X_test, y_test, time_to_fit):
+    '''
+    Scores a fitted pipeline on the test set, pickles it and stores the
+    result in the result cache.
+    Returns a dict with the fold's scores and predictions.
+    '''
+    model_name, param_index, params, over_sampler, fold = task
+    columns = WORKER_DATA['folds'].dataset.columns
+
+    '''
+    Predictions
+    '''
+    predicted = pipeline.predict(X_test)
+
+    try:
+        predicted_prob = pipeline.predict_proba(X_test)
+        predicted_prob = predicted_prob[:, 1]  # probability that label is 1
+
+    except:
+        print("Model has no predict_proba method")
+        predicted_prob = predicted
+
+    '''
+    Evaluation Statistics
+    '''
+    if model_name=='KNN':
+        print("Getting feature support")
+        features = pipeline.named_steps['feat']
+        print(columns[features.get_support()])
+
+    auc_score = metrics.roc_auc_score(y_test, predicted)
+    precision, recall, thresholds = metrics.precision_recall_curve(
+        y_test, predicted_prob)
+    print("AUC score: %0.3f" % auc_score)
+
+    '''
+    Important Features
+    '''
+    print("Top 5 Feature Importance")
+    feature_importances = get_feature_importances(
+        pipeline.named_steps[model_name])
+    if feature_importances is not None:
+        df_best_estimators = pd.DataFrame(feature_importances, columns = ["Imp/Coef"], index = columns).sort_values(by='Imp/Coef', ascending = False)
+        print(df_best_estimators.head(5))
+
+    file_name = (
+        "pickles/{0}_{1}_{2}_paramset:{3}_fold:{4}_{5}.p".format(
+        TIMESTAMP, WORKER_DATA['stage'], model_name, param_index, fold + 1, WORKER_DATA['dem_label'])
+        )
+
+    data = [clf, pipeline, predicted, params] #need to fill in with things that we want to pickle
+    pickle.dump( data, open(file_name, "wb" ) )
+
+    result = {'model_name': model_name,
+              'param_index': param_index,
+              'params': params,
+              'over_sampler': over_sampler,
+              'fold': fold,
+              'auc_score': auc_score,
+              'precision': precision,
+              'recall': recall,
+              'thresholds': thresholds,
+              'predicted_prob': np.asarray(predicted_prob),
+              'y_test': np.asarray(y_test),
+              'time_to_fit': time_to_fit,
+              'pickle': file_name,
+              'cached': False}
+
+    # store from the worker so finished folds survive a crash in the parent
+    WORKER_DATA['cache'].put(task, result)
+    return result
+
+
+def run_fold(task):
+    '''
+    Fits and evaluates one (model, params, oversampler, fold) task.
+    Returns a dict with the fold's scores and predictions.
+    '''
+    model_name, param_index, params, over_sampler, fold = task
+
+    clf, pipeline = make_pipeline(model_name, params, WORKER_DATA['n_jobs'])
+    print(clf)
+    X_resampled, y_resampled, X_test, y_test = _fold_data(model_name, over_sampler, fold)
+
+    t0 = time.clock()
+    pipeline.fit(X_resampled, y_resampled)
+    time_to_fit = (time.clock() - t0)
+    print("done fitting in {}".format(time_to_fit))
+
+    return _evaluate(task, clf, pipeline, X_test, y_test, time_to_fit)
+
+
+def run_warm_start(tasks):
+    '''
+    Fits tasks whose params differ only in n_estimators as one growing
+    ensemble: the smallest ensemble is fit first and each larger one only
+    adds trees/stages to it with warm_start, scoring every size on the way.
+    time_to_fit is the cumulative time to reach each size.
+    Returns the results in the order of tasks.
+    '''
+    by_size = sorted(tasks, key=lambda task: task[2]['n_estimators'])
+    model_name, param_index, params, over_sampler, fold = by_size[0]
+
+    clf, pipeline = make_pipeline(model_name, params, WORKER_DATA['n_jobs'])
+    clf.set_params(warm_start=True)
+    print(clf)
+    print("Growing to n_estimators {}".format([task[2]['n_estimators'] for task in by_size]))
+    X_resampled, y_resampled, X_test, y_test = _fold_data(model_name, over_sampler, fold)
+
+    results = {}
+    time_to_fit = 0
+    for task in by_size:
+        clf.set_params(n_estimators=task[2]['n_estimators'])
+        t0 = time.clock()
+        pipeline.fit(X_resampled, y_resampled)
+        time_to_fit += (time.clock() - t0)
+        print("done fitting {} estimators in {}".format(task[2]['n_estimators'], time_to_fit))
+        results[id(task)] = _evaluate(task, clf, pipeline, X_test, y_test, time_to_fit)
+
+    return [results[id(task)] for task in tasks]
+
+
+def warm_start_key(task):
+    '''
+    Returns the group of tasks that can share one warm-started ensemble:
+    same model, fold, oversampler and params apart from n_estimators.
+    Returns None for tasks that have to be fit on their own.
+    '''
+    model_name, param_index, params, over_sampler, fold = task
+    if model_name not in WARM_START_MODELS or 'n_estimators' not in params:
+        return None
+    others = dict((k, v) for k, v in params.items() if k != 'n_estimators')
+    return (model_name, canonical(others), over_sampler, fold)
+
+
+def run_batch(tasks):
+    '''
+    Runs a batch of tasks handed out by the scheduler. Returns a list with
+    one result per task.
+    '''
+    if len(tasks) == 1:
+        return [run_fold(tasks[0])]
+    return run_warm_start(tasks)
+
+
+def write_fold_result(result, stage, dem_label, label):
+    '''
+    Appends one fold's scores to fold_results.csv.
+    '''
+    with open('fold_results.csv', 'a') as csvfile:
+        spamwriter = csv.writer(csvfile)
+        spamwriter.writerow(
+            [stage,
+            dem_label,
+            label,
+            result['model_name'],
+            result['params'],
+            result['fold'] + 1,
+            result['auc_score'],
+            result['precision'],
+            result['recall'],
+            result['thresholds']])
+
+
+def summarize_cv(fold_results, stage, dem_label, data_label, label):
+    '''
+    Takes the results of every fold for one model/params/oversampler.
+    Prints cross validation statistics, saves PR and ROC plots and appends
+    a row to final_results.csv.
+    '''
+    first = fold_results[0]
+    model_name = first['model_name']
+    params = first['params']
+    over_sampler = first['over_sampler']
+
+    auc_scores = [r['auc_score'] for r in fold_results]
+    overall_predictions = np.concatenate([r['predicted_prob'] for r in fold_results])
+    overall_actual = np.concatenate([r['y_test'] for r in fold_results])
+    folds_completed = len(fold_results)
+
+    print("### Cross Validation Statistics ###")
+    print(model_name, params)
+    print(over_sampler)
+    precision, recall, thresholds = metrics.precision_recall_curve(
+        overall_actual, overall_predictions)
+    print("Length of AUC SCORES: {}".format(len(auc_scores)))
+    average_auc = sum(auc_scores) / len(auc_scores)
+    print("Average AUC: %0.3f" % average_auc)
+    print("Confusion Matrix")
+    overall_binary_predictions = convert_to_binary(overall_predictions)
+    confusion = metrics.confusion_matrix(
+        overall_actual, overall_binary_predictions)
+    print(confusion)
+
+    # Plot precision/recall
+    overall_precision, overall_recall, overall_thresholds = metrics.precision_recall_curve(
+    overall_actual, overall_predictions)
+    plot_file = "plots/PR_{0}_{1}_{2}_{3}.png".format(
+            TIMESTAMP, data_label, model_name, label)
+    plt.plot(overall_recall, overall_precision)
+    plt.title('Precision-Recall curve for {}'.format(model_name+" "+data_label+" "+label))
+    plt.xlabel('Recall')
+    plt.ylabel('Precision')
+    plt.grid(True)
+    plt.savefig(plot_file)
+    plt.close()
+
+    #plot AUC
+    plot_file = "plots/ROC_{0}_{1}_{2}_{3}.png".format(TIMESTAMP, data_label, model_name, label)
+    overall_fpr, overall_tpr, overall_roc_thresholds = metrics.roc_curve(
+            overall_actual, overall_predictions)
+    plt.plot(overall_fpr, overall_tpr)
+    plt.plot([0, 1], [0, 1], 'k--')
+    plt.title('ROC curve for {} (AUC = {})'.format(model_name+" "+data_label+" "+label, round(average_auc,3)))
+    plt.xlabel('False Positive Rate')
+    plt.ylabel('True Positive Rate')
+    plt.grid(True)
+    plt.savefig(plot_file)
+    plt.close()
+
+    with open('final_results.csv', 'a') as csvfile:
+        spamwriter = csv.writer(csvfile)
+        spamwriter.writerow([
+            stage,
+            dem_label,
+            label,
+            model_name,
+            params,
+            over_sampler,
+            folds_completed,
+            precision,
+            recall,
+            thresholds,
+            average_auc
+            ])
+
+
 if __name__ == "__main__":
     '''
     Argument Parsing
     '''
     parser = argparse.ArgumentParser()
-    parser.add_argument('csv', help='csv filename')
+    parser.add_argument('csv', help='csv filename (or .feather/.parquet from final_data --format)')
     parser.add_argument('label', help='label of dependent variable')
     parser.add_argument('to_try', nargs='+', default=['DT'], help='list of model abbreviations')
     parser.add_argument('--pared_down', action="store_true", default=False, help='use tack one on window validation')
     parser.add_argument('--tack_one_on', action="store_true", default=False, help='use tack one on window validation')
     parser.add_argument('--demographic', action="store_true", default=False, help='using demographic info')
+    parser.add_argument('--n_workers', type=int, default=1, help='number of worker processes, -1 for all cores')
+    parser.add_argument('--no_cache', action="store_true", default=False, help='re-parse the csv instead of using cache/datasets')
+    parser.add_argument('--refit', action="store_true", default=False, help='refit every task instead of reusing cache/results')
+    parser.add_argument('--no_warm_start', action="store_true", default=False, help='fit every n_estimators value from scratch')
+    parser.add_argument('--search', choices=['grid', 'halving'], default='grid', help='exhaustive grid or successive halving over folds')
+    parser.add_argument('--halving_keep', type=float, default=1/3., help='fraction of candidates kept after each halving round')
+    parser.add_argument('--budget', type=int, default=None, help='maximum number of fold fits for --search halving')
     args = parser.parse_args()
+    if not 0 < args.halving_keep <= 1:
+        parser.error('--halving_keep must be in (0, 1]')
+    if args.budget is not None and args.budget < 1:
+        parser.error('--budget must be at least 1')
     '''
     Labels for Documenting
     '''
@@ -215,250 +580,63 @@ if __name__ == "__main__":
     train_split, test_split = TRAIN_SPLITS_TACK, TEST_SPLITS_TACK
 
     to_try = args.to_try
-    df = pd.read_csv(args.csv)
 
     if args.demographic:
         FILL_WITH_MEAN.append('complainant_age')
-    
+
+    # parse the csv once; every model and fold reuses the prepared arrays
+    dataset = load_dataset(args.csv, label, TO_DROP, use_cache=not args.no_cache)
+    folds = FoldBuilder(dataset, train_split, test_split, FILL_WITH_MEAN)
+    if not args.no_cache:
+        # impute once here; workers attach to the memory-mapped folds
+        folds.share(os.path.join('cache', 'folds', folds.key()))
+
     '''
     Generate decision tree bases for AdaBoostClassifier
     '''
-    dt_grid = grid_from_class('DT')
-    base_dts = []
-    for i, params in enumerate(dt_grid):
-        dt = CLFS['DT']
-        dt.set_params(**params)
-        base_dts.append(dt)
-    GRID['AB']['base_estimator'] = base_dts
+    GRID['AB']['base_estimator'] = base_estimators('DT', AB_BASE_GRID)
 
     '''
     Trying Models
     '''
-    for model_name in to_try:
-        df = pd.read_csv(args.csv)
-
-        for col in TO_DROP:
-            try:
-                df.drop(col, axis=1, inplace = True)
-            except:
-                continue
-
-        chunks = temporal_split_data(df)
-
-
-        print("### STARTING {} ###".format(model_name))
-
-        '''
-        Iterating Through Model
-        '''
-        grid = grid_from_class(model_name)
-
-        for i, params in enumerate(grid):
-            '''
-            Iterating Through Parameters
-            '''
-            print("### TRYING PARAMS ###")
-            
-            for over_sampler in OVER_SAMPLERS.keys():
-
-                clf = CLFS[model_name]
-                clf.set_params(**params)
-                if hasattr(clf, 'n_jobs'):
-                        clf.set_params(n_jobs=-1)
-
-                print(clf)
-                print(over_sampler)
-                print("######")
-                if model_name=='KNN':
-                    steps = [("normalization", preprocessing.RobustScaler()),('feat', sklearn.feature_selection.SelectKBest(k=10)),
-                     (model_name, clf)]
-                else:
-                    steps = [(model_name, clf)]
-
-                pipeline = sklearn.pipeline.Pipeline(steps)
-                print("pipeline:", [name for name, _ in pipeline.steps])
-
-                auc_scores = []
-                folds_completed = 0
-
-                os_object = OVER_SAMPLERS[over_sampler]
-                print("Oversampler: {}".format(over_sampler))
-
-                for i in range(len(train_split)):
-                    '''
-                    Cross Validation
-                    '''
-                    print("Training sets are: {}".format(train_split[i]))
-                    print("Testing sets are: {}".format(test_split[i]))
-                    for x in range(len(train_split[i])-1):
-                        if x == 0:
-                            train_df=chunks[train_split[i][x]]
-                        train_df = pd.concat(
-                            [train_df, chunks[train_split[i][x+1]]])
-
-                    X_train = train_df.drop(label, axis=1)
-                    y_train = train_df[label]
-                    test_df = chunks[test_split[i]]
-                    X_test = test_df.drop(label, axis=1)
-                    y_test = test_df[label]
-
-                    #IMPUTE VALUES
-
-                    for col in X_train.columns:
-                        try:
-                            if col in FILL_WITH_MEAN:
-                                mean = round(X_train[col].mean())
-                                X_train[col].fillna(value=mean, inplace=True)
-                                X_test[col].fillna(value=mean, inplace=True)
-                            else:
-                                X_train[col].fillna(0, inplace=True)
-                                X_test[col].fillna(0, inplace=True)
-
-                        except:
-                            print('Could not impute column:{}'.format(col))
-                            continue
-
-                    # Resample minority class
-                    if over_sampler != "None":
-                        X_resampled = np.array(X_train)
-                        y_resampled = np.array(y_train)
-                        X_resampled, y_resampled = os_object.fit_transform(X_resampled,y_resampled)
-
-                    else:
-                        X_resampled = X_train
-                        y_resampled = y_train
-
-                    t0 = time.clock()
-                    pipeline.fit(X_resampled, y_resampled)
-                    time_to_fit = (time.clock() - t0)
-                    print("done fitting in {}".format(time_to_fit))
-
-                    '''
-                    Predictions
-                    '''
-                    predicted = pipeline.predict(X_test)
-
-                    try:
-                        predicted_prob = pipeline.predict_proba(X_test)
-                        predicted_prob = predicted_prob[:, 1]  # probability that label is 1
-
-                    except:
-                        print("Model has no predict_proba method")
-
-                    '''
-                    Evaluation Statistics
-                    '''
-                    print()
-                    print("Evaluation Statistics")
-                    if model_name=='KNN':
-                        print("Getting feature support")
-                        features = pipeline.named_steps['feat']
-                        print(X_train.columns[features.transform(np.arange(
-                            len(X_train.columns)))])
-
-
-                    auc_score = metrics.roc_auc_score(y_test, predicted)
-                    precision, recall, thresholds = metrics.precision_recall_curve(
-                        y_test, predicted_prob)
-                    auc_scores.append(auc_score)
-                    print("AUC score: %0.3f" % auc_score)
-
-                    # save predicted/actual to calculate precision/recall later
-                    if folds_completed==0:
-                        overall_predictions = pd.DataFrame(predicted_prob)
-                        overall_actual = y_test
-                    else:
-                        overall_predictions = pd.concat(
-                            [overall_predictions, pd.DataFrame(predicted_prob)])
-                        overall_actual = pd.concat([overall_actual, y_test])
-
-                    '''
-                    Important Features
-                    '''
-                    print("Top 5 Feature Importance")
-                    feature_importances = get_feature_importances(
-                        pipeline.named_steps[model_name])
-                    if feature_importances != None:
-                        df_best_estimators = pd.DataFrame(feature_importances, columns = ["Imp/Coef"], index = X_train.columns).sort_values(by='Imp/Coef', ascending = False)
-                        print(df_best_estimators.head(5))
-
-                    folds_completed += 1
-                    print("Completed {} fold".format(folds_completed))
-
-                    with open('fold_results.csv', 'a') as csvfile:
-                        spamwriter = csv.writer(csvfile)
-                        spamwriter.writerow(
-                            [stage,
-                            dem_label,
-                            label,
-                            model_name,
-                            params,
-                            folds_completed,
-                            auc_score,
-                            precision,
-                            recall,
-                            thresholds])
-
-                    file_name = (
-                        "pickles/{0}_{1}_{2}_paramset:{3}_fold:{4}_{5}.p".format(
-                        TIMESTAMP, stage, model_name, i, folds_completed, dem_label)
-                        )
-
-                    data = [clf, pipeline, predicted, params] #need to fill in with things that we want to pickle
-                    pickle.dump( data, open(file_name, "wb" ) )
-
-                print("### Cross Validation Statistics ###")
-                print(clf)
-                print(over_sampler)
-                precision, recall, thresholds = metrics.precision_recall_curve(
-                    overall_actual, overall_predictions)
-                print("Length of AUC SCORES: {}".format(len(auc_scores)))
-                average_auc = sum(auc_scores) / len(auc_scores)
-                print("Average AUC: %0.3f" % average_auc)
-                print("Confusion Matrix")
-                overall_binary_predictions = convert_to_binary(overall_predictions)
-                confusion = metrics.confusion_matrix(
-                    overall_actual, overall_binary_predictions)
-                print(confusion)
-
-                # Plot precision/recall
-                overall_precision, overall_recall, overall_thresholds = metrics.precision_recall_curve(
-                overall_actual, overall_predictions)
-                plot_file = "plots/PR_{0}_{1}_{2}_{3}.png".format(
-                        TIMESTAMP, data_label, model_name, label)
-                plt.plot(overall_recall, overall_precision)
-                plt.title('Precision-Recall curve for {}'.format(model_name+" "+data_label+" "+label))
-                plt.xlabel('Recall')
-                plt.ylabel('Precision')
-                plt.grid(True)
-                plt.savefig(plot_file)
-                plt.close()
-
-                #plot AUC
-                plot_file = "plots/ROC_{0}_{1}_{2}_{3}.png".format(TIMESTAMP, data_label, model_name, label)
-                overall_fpr, overall_tpr, overall_roc_thresholds = metrics.roc_curve(
-                        overall_actual, overall_predictions)
-                plt.plot(overall_fpr, overall_tpr)
-                plt.plot([0, 1], [0, 1], 'k--')
-                plt.title('ROC curve for {} (AUC = {})'.format(model_name+" "+data_label+" "+label, round(average_auc,3)))
-                plt.xlabel('False Positive Rate')
-                plt.ylabel('True Positive Rate')
-                plt.grid(True)
-                plt.savefig(plot_file)
-                plt.close()
-
-                with open('final_results.csv', 'a') as csvfile:
-                    spamwriter = csv.writer(csvfile)
-                    spamwriter.writerow([
-                        stage,
-                        dem_label,
-                        label,
-                        model_name,
-                        params,
-                        over_sampler,
-                        folds_completed,
-                        precision,
-                        recall,
-                        thresholds,
-                        average_auc
-                        ])
+    n_workers = resolve_workers(args.n_workers)
+    # each worker fits one model at a time, so don't let models fan out too
+    n_jobs = -1 if n_workers == 1 else 1
+
+    grids = dict((model_name, grid_from_class(model_name)) for model_name in to_try)
+    over_samplers = sorted(OVER_SAMPLERS.keys())
+    n_folds = len(train_split)
+
+    # a restarted or extended grid only fits the cells it hasn't finished
+    cache = ResultCache(dataset.key, train_split, test_split, describe_task, FILL_WITH_MEAN)
+
+    def run(tasks):
+        for result in run_tasks(run_batch, tasks, n_workers, _init_worker,
+                                (folds, cache, n_jobs, stage, dem_label),
+                                cache=None if args.refit else cache,
+                                group_key=None if args.no_warm_start else warm_start_key):
+            # results cached by an earlier run are already in the csvs
+            if not result['cached']:
+                print("Completed {} fold".format(result['fold'] + 1))
+                write_fold_result(result, stage, dem_label, label)
+            yield result
+
+    if args.search == 'halving':
+        survivors = successive_halving(to_try, grids, over_samplers, n_folds,
+                                       lambda tasks: list(run(tasks)),
+                                       args.halving_keep, args.budget)
+        for fold_results in survivors:
+            if not all(r['cached'] for r in fold_results):
+                summarize_cv(fold_results, stage, dem_label, data_label, label)
+    else:
+        tasks = build_tasks(to_try, grids, over_samplers, n_folds)
+        print("### RUNNING {} TASKS ON {} WORKERS ###".format(len(tasks), n_workers))
+
+        fold_results = []
+        for result in run(tasks):
+            fold_results.append(result)
+            # tasks come back in order, so the last fold closes out a param set
+            if result['fold'] == n_folds - 1:
+                if not all(r['cached'] for r in fold_results):
+                    summarize_cv(fold_results, stage, dem_label, data_label, label)
+                fold_results = []
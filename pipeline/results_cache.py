@@ -0,0 +1,100 @@
+"""
+Content-addressed cache of fold results for pipeline.py, so an
+interrupted or extended grid search only fits the tasks it has not
+already finished.
+
+A task's key is the sha1 of the dataset hash, the imputed columns, the
+full configuration of the estimator and oversampler (from a describe
+function supplied by the caller, so edited defaults miss the cache), the
+fold index and the chunks making up that fold. Each result is pickled to
+cache/results/<key[:2]>/<key>.p.
+"""
+
+import hashlib
+import os
+import pickle
+
+CACHE_DIR = os.path.join('cache', 'results')
+
+
+def canonical(value):
+    '''
+    Returns a stable string for a parameter value. Estimators (e.g. an
+    AdaBoost base_estimator) are described by class name and parameters
+    rather than by their default repr, which can change between runs.
+    '''
+    if hasattr(value, 'get_params'):
+        params = value.get_params(deep=False)
+        return '{}({})'.format(type(value).__name__, canonical(params))
+    if isinstance(value, dict):
+        return '{' + ', '.join('{!r}: {}'.format(k, canonical(value[k]))
+                               for k in sorted(value)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(canonical(v) for v in value) + ']'
+    return repr(value)
+
+
+class ResultCache(object):
+    '''
+    Stores and looks up fold results for one dataset and set of splits.
+    describe(model_name, params, over_sampler) returns the string keyed
+    for a task's model and oversampler; it must be a module-level function
+    so the cache can be sent to worker processes. fill_columns are the
+    columns imputed with the training mean.
+    '''
+
+    def __init__(self, dataset_key, train_split, test_split, describe, fill_columns=(),
+                 cache_dir=CACHE_DIR):
+        self.dataset_key = dataset_key
+        self.train_split = train_split
+        self.test_split = test_split
+        self.describe = describe
+        self.fill_columns = list(fill_columns)
+        self.cache_dir = cache_dir
+
+    def key(self, task):
+        model_name, param_index, params, over_sampler, fold = task
+        description = canonical([self.dataset_key, self.fill_columns,
+                                 self.describe(model_name, params, over_sampler),
+                                 fold, self.train_split[fold], self.test_split[fold]])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def path(self, task):
+        key = self.key(task)
+        return os.path.join(self.cache_dir, key[:2], key + '.p')
+
+    def has(self, task):
+        return os.path.exists(self.path(task))
+
+    def get(self, task):
+        '''
+        Returns the cached result for task, or None if there isn't one.
+        The result's bookkeeping fields are updated to match task, since
+        the same cell may sit at a different position in a new grid.
+        '''
+        try:
+            with open(self.path(task), 'rb') as f:
+                result = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        model_name, param_index, params, over_sampler, fold = task
+        result.update(param_index=param_index, params=params, cached=True)
+        return result
+
+    def put(self, task, result):
+        '''
+        Writes result for task. The file is written under a temporary name
+        and renamed, so an interrupted write never looks like a result.
+        '''
+        path = self.path(task)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another worker made it first
+                pass
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.rename(tmp_path, path)
@@ -0,0 +1,128 @@
+"""
+Turns the model x parameter set x oversampler x fold cross product from
+pipeline.py into independent tasks and runs them on a process pool.
+
+Tasks that can share work (e.g. one warm-started ensemble) can be
+grouped into batches that run together in a single worker.
+
+Results are always handed back in task order, regardless of which worker
+finishes first, so the rows written to fold_results.csv/final_results.csv
+come out in the same order as a single process run.
+"""
+
+import itertools
+import multiprocessing
+
+
+def build_tasks(to_try, grids, over_samplers, n_folds):
+    '''
+    Takes the list of model abbreviations, a dict of model name -> list of
+    parameter dicts, the oversampler names and the number of folds.
+    Returns a list of (model_name, param_index, params, over_sampler, fold)
+    tuples with the fold varying fastest.
+    '''
+    tasks = []
+    for model_name in to_try:
+        grid = grids[model_name]
+        for (param_index, params), over_sampler, fold in itertools.product(
+                enumerate(grid), over_samplers, range(n_folds)):
+            tasks.append((model_name, param_index, params, over_sampler, fold))
+    return tasks
+
+
+def resolve_workers(n_workers):
+    '''
+    Converts the --n_workers argument into a process count, where -1 means
+    use every core.
+    '''
+    if n_workers is None or n_workers < 1:
+        return multiprocessing.cpu_count()
+    return n_workers
+
+
+def batch_tasks(tasks, group_key=None):
+    '''
+    Groups task indices into batches that should run together in one
+    worker. Tasks whose group_key is None (or all tasks, without a
+    group_key) run alone. Batches are ordered by their first task.
+    '''
+    batches = []
+    groups = {}
+    for i, task in enumerate(tasks):
+        key = group_key(task) if group_key is not None else None
+        if key is None:
+            batches.append([i])
+        elif key in groups:
+            groups[key].append(i)
+        else:
+            groups[key] = [i]
+            batches.append(groups[key])
+    return batches
+
+
+def run_tasks(func, tasks, n_workers=1, initializer=None, initargs=(), cache=None,
+              group_key=None):
+    '''
+    Applies func to batches of tasks and yields one result per task, in
+    task order. func takes a list of tasks and returns their results.
+    With a single worker everything runs in this process, which keeps
+    tracebacks and pdb usable.
+    If a cache is given, tasks it already has a result for are not run
+    again and their cached results are yielded in their place.
+    '''
+    if cache is not None:
+        done = [cache.has(task) for task in tasks]
+        print("{} of {} tasks already in the result cache".format(sum(done), len(tasks)))
+    else:
+        done = [False] * len(tasks)
+    pending = [i for i, is_done in enumerate(done) if not is_done]
+
+    batches = [[pending[j] for j in batch]
+               for batch in batch_tasks([tasks[i] for i in pending], group_key)]
+    batch_order = iter(batches)
+    results = _run(func, [[tasks[i] for i in batch] for batch in batches],
+                   n_workers, initializer, initargs)
+
+    finished = {}
+    initialized = False
+    for i, task in enumerate(tasks):
+        if not done[i]:
+            # batches come back in order of their first task, so anything
+            # needed now is in a batch that has already been handed out
+            while i not in finished:
+                finished.update(zip(next(batch_order), next(results)))
+            yield finished.pop(i)
+            continue
+        result = cache.get(task)
+        if result is None:
+            # unreadable cache entry; refit it here rather than in the pool
+            if not initialized and initializer is not None:
+                initializer(*initargs)
+                initialized = True
+            result = func([task])[0]
+        yield result
+
+
+def _run(func, tasks, n_workers, initializer, initargs):
+    n_workers = resolve_workers(n_workers)
+    if not tasks:
+        return
+    if n_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+
+    pool = multiprocessing.Pool(processes=n_workers, initializer=initializer,
+                                initargs=initargs)
+    try:
+        # imap preserves task order while workers pick up tasks as they free up
+        for result in pool.imap(func, tasks, chunksize=1):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,99 @@
+"""
+Successive halving search over the pipeline.py grids. Every candidate
+(parameter set x oversampler) is first scored on the earliest temporal
+fold; only the best fraction of each model's candidates by AUC moves on
+to the next fold, and so on until the survivors have seen every fold.
+"""
+
+import itertools
+import math
+
+
+def candidates_from_grids(to_try, grids, over_samplers):
+    '''
+    Returns a dict of model name -> list of (param_index, params,
+    over_sampler) candidates, in the same order as the exhaustive search.
+    '''
+    return dict((model_name, [(param_index, params, over_sampler)
+                              for (param_index, params), over_sampler in itertools.product(
+                                  enumerate(grids[model_name]), over_samplers)])
+                for model_name in to_try)
+
+
+def _mean(values):
+    return sum(values) / float(len(values))
+
+
+def _trim_to_budget(survivors, allowed):
+    '''
+    Keeps the best candidates across models so that at most allowed tasks
+    run, giving every model its best candidate before anyone's second.
+    Before the first fold has been scored, candidates are in grid order.
+    '''
+    trimmed = dict((m, []) for m in survivors)
+    for depth in itertools.count():
+        added = False
+        for model_name in sorted(survivors):
+            if allowed <= 0:
+                return trimmed
+            if depth < len(survivors[model_name]):
+                trimmed[model_name].append(survivors[model_name][depth])
+                allowed -= 1
+                added = True
+        if not added:
+            return trimmed
+
+
+def successive_halving(to_try, grids, over_samplers, n_folds, run, keep=1/3., budget=None):
+    '''
+    Takes the models to try, their parameter grids, the oversampler names
+    and the number of folds. run takes a list of (model_name, param_index,
+    params, over_sampler, fold) tasks and returns their results in order.
+
+    After each fold, only the top keep fraction of each model's candidates
+    (by mean AUC over the folds seen so far) go on to the next fold.
+    budget caps the total number of fold fits; if the next fold would go
+    over it, only the best candidates that fit are carried forward.
+
+    Returns a list with the fold results of each final survivor that ran
+    at least one fold, ordered by model and then by rank.
+    '''
+    if not 0 < keep <= 1:
+        raise ValueError('keep must be in (0, 1], got {}'.format(keep))
+    if budget is not None and budget < 1:
+        raise ValueError('budget must be at least 1, got {}'.format(budget))
+    survivors = candidates_from_grids(to_try, grids, over_samplers)
+    fold_results = {}
+    spent = 0
+
+    for fold in range(n_folds):
+        n_tasks = sum(len(c) for c in survivors.values())
+        if budget is not None and spent + n_tasks > budget:
+            if budget - spent <= 0:
+                print("### BUDGET OF {} FITS USED UP AFTER {} FOLDS ###".format(budget, fold))
+                break
+            survivors = _trim_to_budget(survivors, budget - spent)
+            n_tasks = sum(len(c) for c in survivors.values())
+
+        print("### HALVING ROUND {}: {} CANDIDATES ###".format(fold + 1, n_tasks))
+        tasks = [(model_name, param_index, params, over_sampler, fold)
+                 for model_name in to_try
+                 for param_index, params, over_sampler in survivors[model_name]]
+        for result in run(tasks):
+            key = (result['model_name'], result['param_index'], result['over_sampler'])
+            fold_results.setdefault(key, []).append(result)
+        spent += n_tasks
+
+        if fold == n_folds - 1:
+            break
+        for model_name in to_try:
+            ranked = sorted(survivors[model_name], reverse=True,
+                            key=lambda c: _mean([r['auc_score'] for r in
+                                                 fold_results[(model_name, c[0], c[2])]]))
+            n_keep = max(1, int(math.ceil(len(ranked) * keep)))
+            survivors[model_name] = ranked[:n_keep]
+
+    return [fold_results[(model_name, param_index, over_sampler)]
+            for model_name in to_try
+            for param_index, params, over_sampler in survivors[model_name]
+            if (model_name, param_index, over_sampler) in fold_results]
@@ -0,0 +1,80 @@
+'''
+Checks folds.py's FoldBuilder against the concat + fillna fold building
+pipeline.py used to do on DataFrame chunks. Run with
+python -m pytest pipeline.
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from dataset import prepare
+from folds import FoldBuilder
+
+TRAIN_SPLITS_TACK = [[0, 1], [0, 1, 2], [0, 1, 2, 3]]
+TEST_SPLITS_TACK = [2, 3, 4]
+FILL_WITH_MEAN = ['officers_age', 'agesqrd']
+
+
+def random_frame(n=203, seed=0):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'dateobj': pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.randint(0, 2000, n), unit='D'),
+        'label': rng.randint(0, 2, n),
+        'officers_age': rng.randint(20, 65, n).astype(float),
+        'agesqrd': rng.randint(400, 4000, n).astype(float),
+        'priors': rng.randint(0, 20, n).astype(float),
+        'crimes': rng.randint(0, 200, n).astype(float),
+        })
+    for col in ['officers_age', 'agesqrd', 'priors', 'crimes']:
+        df.loc[rng.rand(n) < 0.2, col] = np.nan
+    # nothing to take the mean of in the first chunks
+    df.loc[df.dateobj < df.dateobj.quantile(0.5), 'agesqrd'] = np.nan
+    return df
+
+
+def old_folds(df, label, train_split, test_split):
+    '''What pipeline.py did before FoldBuilder: concatenated chunks, imputed column by column'''
+    df = df.sort_values(by='dateobj', kind='mergesort').drop('dateobj', axis=1)
+    chunks = [df.iloc[rows] for rows in np.array_split(np.arange(len(df)), 5)]
+    for train, test in zip(train_split, test_split):
+        train_df = pd.concat([chunks[c] for c in train])
+        X_train, y_train = train_df.drop(label, axis=1), train_df[label]
+        X_test, y_test = chunks[test].drop(label, axis=1), chunks[test][label]
+        X_train, X_test = X_train.copy(), X_test.copy()
+        for col in X_train.columns:
+            if col in FILL_WITH_MEAN:
+                mean = X_train[col].mean()
+                fill = 0 if np.isnan(mean) else round(mean)
+            else:
+                fill = 0
+            X_train[col] = X_train[col].fillna(fill)
+            X_test[col] = X_test[col].fillna(fill)
+        yield X_train.values, y_train.values, X_test.values, y_test.values
+
+
+def test_folds_match_concat_and_fillna():
+    df = random_frame()
+    folds = FoldBuilder(prepare(df, 'label'), TRAIN_SPLITS_TACK, TEST_SPLITS_TACK, FILL_WITH_MEAN)
+    for fold, expected in enumerate(old_folds(df, 'label', TRAIN_SPLITS_TACK, TEST_SPLITS_TACK)):
+        for got, want in zip(folds.fold(fold), expected):
+            np.testing.assert_allclose(got, want)
+        # the same arrays every time it is asked for
+        assert folds.fold(fold)[0] is folds.fold(fold)[0]
+
+
+def test_sparse_folds_match_dense():
+    df = random_frame(seed=1)
+    rng = np.random.RandomState(2)
+    dummies = sp.random(len(df), 30, density=0.05, format='csr', random_state=rng, dtype=np.float32)
+    dummies.data[:] = 1
+    dummy_columns = ['d{}'.format(i) for i in range(30)]
+
+    sparse = FoldBuilder(prepare(df, 'label', dummies=dummies, dummy_columns=dummy_columns),
+                         TRAIN_SPLITS_TACK, TEST_SPLITS_TACK, FILL_WITH_MEAN)
+    wide = pd.concat([df, pd.DataFrame(dummies.toarray(), columns=dummy_columns, index=df.index)], axis=1)
+    dense = FoldBuilder(prepare(wide, 'label'), TRAIN_SPLITS_TACK, TEST_SPLITS_TACK, FILL_WITH_MEAN)
+    for fold in range(len(TRAIN_SPLITS_TACK)):
+        assert sp.issparse(sparse.fold(fold)[0])
+        for got, want in zip(sparse.dense_fold(fold), dense.fold(fold)):
+            np.testing.assert_allclose(got, want)
@@ -0,0 +1,64 @@
+'''
+Checks that scheduler.py hands back results in task order when tasks are
+batched, skipped because they are cached, or run on a pool. Run with
+python -m pytest pipeline.
+'''
+
+from scheduler import batch_tasks, build_tasks, run_tasks
+
+
+def fit(tasks):
+    '''Stands in for pipeline.run_batch: one result per task, noting the batch it ran in'''
+    return [{'task': task, 'batch': tuple(tasks), 'cached': False} for task in tasks]
+
+
+def model_key(task):
+    # warm_start_key groups one model's cells across n_estimators; here whole models
+    return task[0] if task[0] == 'RF' else None
+
+
+class FakeCache(object):
+    '''Holds results for some tasks; one of them unreadable. Keyed by repr, since tasks hold dicts'''
+
+    def __init__(self, tasks, broken=None):
+        self.results = dict((repr(task), {'task': task, 'cached': True}) for task in tasks)
+        self.broken = repr(broken)
+
+    def has(self, task):
+        return repr(task) in self.results or repr(task) == self.broken
+
+    def get(self, task):
+        return self.results.get(repr(task))
+
+
+def grid_tasks():
+    grids = {'RF': [{'n': 1}, {'n': 2}], 'LR': [{'C': 1}, {'C': 2}, {'C': 3}]}
+    return build_tasks(['LR', 'RF'], grids, ['None', 'ROS'], 2)
+
+
+def test_batches_keep_first_task_order():
+    tasks = ['x', 'RF1', 'y', 'RF2', 'z']
+    batches = batch_tasks(tasks, lambda t: 'RF' if t.startswith('RF') else None)
+    assert batches == [[0], [1, 3], [2], [4]]
+    assert batch_tasks(tasks) == [[0], [1], [2], [3], [4]]
+
+
+def test_results_in_task_order_with_cache_and_batches():
+    tasks = grid_tasks()
+    cached = tasks[1::3]
+    cache = FakeCache(cached, broken=tasks[2])
+    for n_workers in [1, 2]:
+        results = list(run_tasks(fit, tasks, n_workers, cache=cache, group_key=model_key))
+        assert [r['task'] for r in results] == tasks
+        for task, result in zip(tasks, results):
+            # cached results are served, everything else (and the unreadable entry) is fit
+            assert result['cached'] == (task in cached)
+            if task[0] == 'RF' and task not in cached:
+                assert result['batch'] == tuple(t for t in tasks if t[0] == 'RF' and t not in cached)
+
+
+def test_no_cache_fits_everything_once():
+    tasks = grid_tasks()
+    results = list(run_tasks(fit, tasks, 1))
+    assert [r['task'] for r in results] == tasks
+    assert all(r['batch'] == (r['task'],) for r in results)
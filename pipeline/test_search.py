@@ -0,0 +1,81 @@
+'''
+Checks search.py's successive halving against a plain reference that
+refits every survivor on every fold seen so far. Run with
+python -m pytest pipeline.
+'''
+
+import math
+
+import pytest
+
+from search import successive_halving, _trim_to_budget, candidates_from_grids
+
+
+GRIDS = {
+    'A': [{'p': i} for i in range(9)],
+    'B': [{'p': i} for i in range(4)],
+}
+OVER_SAMPLERS = ['None', 'ROS']
+
+
+def auc(model_name, params, over_sampler, fold):
+    '''A fixed, tie-free score for every cell'''
+    return ((params['p'] * 7 + len(model_name) * 3 + (over_sampler == 'ROS') * 5 + fold * 11) % 17) / 17.
+
+
+class Runner(object):
+    '''Stands in for pipeline.py's run: scores each task and remembers every task it ran'''
+
+    def __init__(self):
+        self.tasks = []
+
+    def __call__(self, tasks):
+        self.tasks += tasks
+        return [{'model_name': m, 'param_index': i, 'over_sampler': o, 'fold': f,
+                 'auc_score': auc(m, params, o, f)}
+                for m, i, params, o, f in tasks]
+
+
+def reference(to_try, grids, over_samplers, n_folds, keep):
+    '''Survivors of each round, ranking by the mean AUC over every fold seen'''
+    survivors = candidates_from_grids(to_try, grids, over_samplers)
+    for fold in range(n_folds - 1):
+        for model_name in to_try:
+            mean = lambda c: sum(auc(model_name, c[1], c[2], f) for f in range(fold + 1)) / (fold + 1.)
+            ranked = sorted(survivors[model_name], key=mean, reverse=True)
+            survivors[model_name] = ranked[:max(1, int(math.ceil(len(ranked) * keep)))]
+    return [(model_name, c[0], c[2]) for model_name in to_try for c in survivors[model_name]]
+
+
+def test_survivors_match_reference():
+    run = Runner()
+    results = successive_halving(['A', 'B'], GRIDS, OVER_SAMPLERS, 3, run, keep=1/3.)
+    got = [(r[0]['model_name'], r[0]['param_index'], r[0]['over_sampler']) for r in results]
+    assert got == reference(['A', 'B'], GRIDS, OVER_SAMPLERS, 3, 1/3.)
+    # every survivor has a result for every fold, in fold order
+    assert all([r['fold'] for r in fold_results] == [0, 1, 2] for fold_results in results)
+    # 18 + 8 candidates, then 6 + 3, then 2 + 1
+    assert len(run.tasks) == 26 + 9 + 3
+
+
+def test_budget_caps_fits():
+    for budget in [1, 5, 26, 30, 100]:
+        run = Runner()
+        results = successive_halving(['A', 'B'], GRIDS, OVER_SAMPLERS, 3, run, keep=1/3., budget=budget)
+        assert len(run.tasks) <= budget
+        assert len(results) > 0
+        ran = set((t[0], t[1], t[3]) for t in run.tasks)
+        assert all((r[0]['model_name'], r[0]['param_index'], r[0]['over_sampler']) in ran for r in results)
+
+
+def test_trim_gives_every_model_its_best_first():
+    survivors = {'A': ['a1', 'a2', 'a3'], 'B': ['b1'], 'C': ['c1', 'c2']}
+    assert _trim_to_budget(survivors, 4) == {'A': ['a1', 'a2'], 'B': ['b1'], 'C': ['c1']}
+    assert _trim_to_budget(survivors, 2) == {'A': ['a1'], 'B': ['b1'], 'C': []}
+    assert _trim_to_budget(survivors, 10) == survivors
+
+
+def test_rejects_bad_arguments():
+    for kwargs in [{'budget': 0}, {'keep': 0}, {'keep': 1.5}]:
+        with pytest.raises(ValueError):
+            successive_halving(['A'], GRIDS, OVER_SAMPLERS, 3, Runner(), **kwargs)
@@ -7,22 +7,39 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from argparse import ArgumentParser
-import time, datetime, re, pickle, sys
+import time, datetime, re, pickle, sys, os
 import seaborn as sns
 sns.set(color_codes=True)
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'db_tools'))
+
 
 def read_in(path, filetype = 'csv'):
     """
-    Read file to pandas dataframe. Currently only csv is allowed and
-    is the default. Plan on extending later.
+    Read file to pandas dataframe. Supports csv (the default) and the
+    feather/parquet files written by final_data's --format option, which
+    keep their column dtypes.
     """
     if filetype == 'csv':
         return pd.read_csv(path, index_col=0)
+    elif filetype == 'feather':
+        return pd.read_feather(path)
+    elif filetype == 'parquet':
+        return pd.read_parquet(path)
     else:
         sys.exit("Filetype not supported.")
 
 
+def read_db(query):
+    """
+    Read a table name or SELECT straight from the police database,
+    streamed with COPY (see db_tools/extract.py) with column types
+    taken from the database.
+    """
+    from extract import read_table
+    return read_table(query)
+
+
 def get_null_freq(df):
     """
     For a given DataFrame, calculates how many values for
@@ -157,27 +174,39 @@ def summarize_data(df, html = True):
     #     plt.show()
 
 
-def go(path):
+def go(path, sql = None, filetype = None):
     '''
-    all-in-one function that reads a path into a pandas dataframe,
+    all-in-one function that reads a path (feather or parquet by
+    extension, anything else as csv, unless filetype says otherwise) or,
+    given sql, a table or query from the database into a pandas dataframe,
     snakes the columns, and summarizes the data.
     '''
-    df = read_in(path)
+    name, extension = os.path.splitext(path)
+    if filetype is None:
+        filetype = extension.lstrip('.').lower()
+        if filetype not in ('feather', 'parquet'):
+            filetype = 'csv'
+    if sql is not None:
+        df = read_db(sql)
+    else:
+        df = read_in(path, filetype)
     df = snake_columns(df)
     #create data dict
-    df.dtypes.to_csv('{0}_data-dict_{1}'.format(TIMESTAMP, path.strip(".csv")), header=True)
+    df.dtypes.to_csv('{0}_data-dict_{1}'.format(TIMESTAMP, name), header=True)
     summarize_data(df)
-    file_name = "{0}_cleaned-df_{1}.p".format(TIMESTAMP, path.strip(".csv"))
+    file_name = "{0}_cleaned-df_{1}.p".format(TIMESTAMP, name)
     data = [df] #need to fill in with things that we want to pickle
     pickle.dump( data, open(file_name, "wb" ) )
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
-    parser.add_argument('csv')
+    parser.add_argument('csv', help = 'file to read, or the output name with --sql')
+    parser.add_argument('--sql', help = 'table name or SELECT to read from the database instead')
+    parser.add_argument('--filetype', help = 'csv, feather or parquet; by default feather/parquet by extension, else csv')
     args = parser.parse_args()
 
     TS = time.time()
     TIMESTAMP = datetime.datetime.fromtimestamp(TS).strftime('%Y-%m-%d')
 
-    go(args.csv)
+    go(args.csv, args.sql, args.filetype)